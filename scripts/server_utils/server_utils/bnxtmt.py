@@ -1,17 +1,29 @@
+import json
 import logging
 import os
 import re
 import sys
-from copy import copy
 import signal
+from time import sleep
+from typing import Dict, List, Tuple
 
 from pexpect import spawn
 from pexpect.exceptions import TIMEOUT as Timeout
 
+from server_utils.config import config
 from server_utils.nic import Nic
+from server_utils.server import ansi_escape
 
 log = logging.getLogger(__name__)
 
+# Device tables cached on the client, see Bnxtmt.device_table()
+DEVICE_TABLE_FILE = "bnxtmt_devices.json"
+# server name -> {'key': device table key, 'devices': {bnxtmt BDF: bnxtmt device number}}
+_device_tables = dict()
+
+# Printed with puts after each command of a batch, to split the output. Formatted with the command index.
+BATCH_MARKER = "@@bnxtmt batch {}@@"
+
 
 def prompt(device: int) -> str:
     """Return the expected bnxtmt prompt given the device number."""
@@ -26,13 +38,262 @@ def slow_sendline(exp: spawn, string: str):
     exp.send('\n')
 
 
+def pipelined_sendline(exp: spawn, string: str, timeout: float = -1):
+    """
+    Send the whole line at once and wait for the whole echo, so a command costs one round trip instead of one per
+    character. The newline is only sent after the echo, so nothing has run if the echo times out.
+    """
+    exp.send(string)
+    exp.expect_exact(string, timeout=timeout)
+    exp.send('\n')
+
+
+class TraceDelta:
+    """
+    Extract the lines added to the primate trace since the last poll.
+
+    Each poll returns the newest lines of the trace ring, and each trace line starts with a time stamp. The new lines
+    are found by walking back from the end of the buffer to the newest time stamp of the last poll, so the cost is
+    proportional to the number of new lines, not to the size of the buffer. Lines with the same time stamp as the end
+    of the last poll are counted, so repeated lines are not lost.
+    """
+    TIME_STAMP = re.compile(r"(\d+\.\d+):")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Time stamp of the newest line of the last poll
+        self.last_time = None
+        # Number of lines of the last poll with that time stamp
+        self.last_count = 0
+
+    def new_lines(self, buffer: str) -> Tuple[List[str], bool]:
+        """
+        Return the trace lines in the buffer that are newer than the last poll, oldest first, and whether lines were
+        lost because the trace ring wrapped between the polls. Lines without a time stamp are skipped.
+        """
+        # Newest first
+        newer = []
+        times = []
+        # Lines with the last time stamp, newest first
+        same = []
+        # Set when the walk reaches the start of the buffer without finding the last poll
+        gap = self.last_time is not None
+        end = len(buffer)
+        while end > 0:
+            start = buffer.rfind('\n', 0, end) + 1
+            line = buffer[start:end]
+            end = start - 1
+            match = self.TIME_STAMP.match(line)
+            if match is None:
+                continue
+            time = float(match.group(1))
+            if self.last_time is None or time > self.last_time:
+                newer.append(line)
+                times.append(time)
+                continue
+            gap = False
+            if time < self.last_time:
+                if not newer and not same:
+                    log.warning("The primate trace went back in time. The firmware may have been reset.")
+                    self.reset()
+                    return self.new_lines(buffer)
+                break
+            same.append(line)
+        if len(same) > self.last_count:
+            # More lines with the last time stamp than at the last poll, the newest ones are new
+            extra = len(same) - self.last_count
+            newer += same[:extra]
+            times += [self.last_time] * extra
+        if times:
+            if times[0] == self.last_time:
+                self.last_count = len(same)
+            else:
+                self.last_time = times[0]
+                self.last_count = 0
+                for time in times:
+                    if time != self.last_time:
+                        break
+                    self.last_count += 1
+        newer.reverse()
+        return newer, gap and bool(newer)
+
+
+class _EchoTimeout(Exception):
+    """The whole line echo did not arrive. The line was not sent to bnxtmt."""
+
+
+class BnxtmtSession:
+    """
+    Long-lived interactive bnxtmt session.
+
+    bnxtmt is started once with load.sh in an expect session on the server, and commands are run at its prompt. The
+    device is only selected when it changes. If a command does not return to the prompt before the timeout, the tool is
+    killed, and it is restarted by the next command.
+
+    Commands are sent a whole line at a time. If bnxtmt does not echo a whole line, the tool is restarted and commands
+    are sent one character at a time with slow_sendline() for the rest of the session.
+    """
+    def __init__(self, bnxtmt: 'Bnxtmt', timeout: float = 120, pipelined: bool = True, echo_timeout: float = 5):
+        """
+        :param bnxtmt: Bnxtmt to run
+        :param timeout: default seconds to wait for a command to finish
+        :param pipelined: send whole lines, see pipelined_sendline()
+        :param echo_timeout: seconds to wait for the echo of a whole line before falling back to slow_sendline()
+        """
+        self.bnxtmt = bnxtmt
+        self.timeout = timeout
+        self.pipelined = pipelined
+        self.echo_timeout = echo_timeout
+        # Output of bnxtmt before the first prompt, which includes the device list
+        self.startup_lines = []
+        self._exp = None
+        self._device = None
+        # Whether bnxtmt runs puts, which batches use to split the output. None until checked.
+        self._batch_markers = None
+
+    def start(self):
+        """Start bnxtmt, killing any other bnxtmt process first."""
+        self.bnxtmt.killall()
+        log.debug("Starting bnxtmt session.")
+        exp = self.bnxtmt.server.get_expect_session()
+        exp.sendline(f"cd {self.bnxtmt.path}")
+        exp.expect(self.bnxtmt.server.prompt)
+        exp.sendline(f"./load.sh")
+        exp.delaybeforesend = None
+        # A wide terminal keeps long command lines from being wrapped in the echo
+        exp.setwinsize(24, 1024)
+        exp.expect_exact(prompt(1), timeout=self.timeout)
+        self.startup_lines = ansi_escape.sub('', exp.before).splitlines()
+        self._exp = exp
+        self._device = 1
+
+    def close(self):
+        """Close the expect session. Use Bnxtmt.killall() to also make sure bnxtmt has exited."""
+        if self._exp is not None:
+            self._exp.close(force=True)
+        self._exp = None
+        self._device = None
+
+    @property
+    def active(self) -> bool:
+        return self._exp is not None
+
+    def _sendline(self, command: str):
+        if not self.pipelined:
+            slow_sendline(self._exp, command)
+            return
+        try:
+            pipelined_sendline(self._exp, command, self.echo_timeout)
+        except Timeout:
+            raise _EchoTimeout()
+
+    def _run(self, command: str, device: int, timeout: float) -> List[str]:
+        self._sendline(command)
+        self._exp.expect_exact(prompt(device), timeout=timeout)
+        output = ansi_escape.sub('', self._exp.before).splitlines()
+        log.debug(f"bnxtmt {device}: {command}\n" + "\n".join(output))
+        return output
+
+    def run(self, command: str, device: int = None, timeout: float = None, retry: bool = False) -> List[str]:
+        """
+        Run a bnxtmt command and return its output lines.
+
+        :param command: bnxtmt command
+        :param device: bnxtmt device number to run the command on. By default, the current device is used.
+        :param timeout: seconds to wait for the command to finish. Defaults to the session timeout.
+        :param retry: restart bnxtmt and run the command again if it times out. Only use for commands that are safe to
+                      repeat.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        while True:
+            try:
+                if not self.active:
+                    self.start()
+                if device is not None and device != self._device:
+                    self._run(f"device {device}", device, self.timeout)
+                    self._device = device
+                return self._run(command, self._device, timeout)
+            except _EchoTimeout:
+                # Nothing was run, so the command is always safe to send again
+                log.warning("bnxtmt did not echo a whole line. Restarting bnxtmt and sending one character at a time.")
+                self.pipelined = False
+                self.bnxtmt.killall()
+            except Timeout:
+                log.warning(f"Timed out waiting on bnxtmt command '{command}'. Restarting bnxtmt.")
+                self.bnxtmt.killall()
+                if not retry:
+                    raise
+                retry = False
+
+    def run_batch(self, commands: List[str], device: int = None, timeout: float = None) -> List[List[str]]:
+        """
+        Run several bnxtmt commands as one command line, like load.sh -eval, and return the output lines of each.
+
+        bnxtmt evaluates the command line as Tcl, so a marker is printed with puts after each command to split the
+        output. If bnxtmt does not print the marker, the commands are run one at a time instead.
+        """
+        if self._batch_markers is None:
+            marker = BATCH_MARKER.format("check")
+            lines = self.run(f"puts {{{marker}}}", retry=True)
+            self._batch_markers = marker in [line.strip() for line in lines]
+            if not self._batch_markers:
+                log.debug("bnxtmt does not support batch markers. Batches are run one command at a time.")
+        if not self._batch_markers:
+            return [self.run(command, device, timeout) for command in commands]
+        command_line = "; ".join(f"{command}; puts {{{BATCH_MARKER.format(i)}}}" for i, command in enumerate(commands))
+        results = [[]]
+        for line in self.run(command_line, device, timeout):
+            if line.strip() == BATCH_MARKER.format(len(results) - 1):
+                results.append([])
+            else:
+                results[-1].append(line)
+        # Anything after the last marker, such as the echo of the command line, belongs to no command
+        results.pop()
+        if len(results) != len(commands):
+            raise ValueError(f"Cannot split bnxtmt output of '{command_line}'. Only found {len(results)} of "
+                             f"{len(commands)} commands.")
+        return results
+
+
+class BnxtmtBatch:
+    """
+    Collect bnxtmt commands for a device and run them as one command line.
+
+        batch = bnxtmt.batch(nic)
+        erase = batch.add(f"nvm erase {dir_entry}")
+        reset = batch.add("reset all")
+        results = batch.run()
+        print(results[reset])
+    """
+    def __init__(self, session: BnxtmtSession, device: int = None):
+        self.session = session
+        self.device = device
+        self.commands = []
+
+    def add(self, command: str) -> int:
+        """Add a command. Returns the index of its output in the results of run()."""
+        self.commands.append(command)
+        return len(self.commands) - 1
+
+    def run(self, timeout: float = None) -> List[List[str]]:
+        """Run the commands and return the output lines of each. The batch is emptied."""
+        commands = self.commands
+        self.commands = []
+        if not commands:
+            return []
+        return self.session.run_batch(commands, self.device, timeout)
+
+
 class Bnxtmt:
     def __init__(self, sit, server):
         self.sit = sit
         self.server = server
+        self._session = None
         self._path = None
-        self._last_buffer_hash = None
-        self._trace_buffer = None
+        self._trace_delta = TraceDelta()
         self._pci_bdf = None
         self._device = None
 
@@ -51,11 +312,81 @@ class Bnxtmt:
                                         f" {self.sit.path}")
         return self._path
 
+    @property
+    def session(self) -> BnxtmtSession:
+        """Return the interactive bnxtmt session. bnxtmt is started by the first command."""
+        if self._session is None:
+            self._session = BnxtmtSession(self)
+        return self._session
+
+    def batch(self, nic: Nic = None) -> BnxtmtBatch:
+        """Return a batch of commands for the NIC, or for the current device if no NIC is given."""
+        return BnxtmtBatch(self.session, nic.bnxtmt_device if nic is not None else None)
+
     def killall(self):
-        """Kill all bnxtmt processes on the remote server."""
+        """Kill all bnxtmt processes on the remote server, including the one of the session."""
+        if self._session is not None:
+            self._session.close()
         log.debug("Killing all bnxtmt processes.")
         self.server.exec("killall bnxtmt", False)
 
+    def _device_table_key(self) -> dict:
+        """Return what the bnxtmt device numbers depend on: the kernel and the NICs in the server."""
+        inventory = self.server.inventory
+        return {'kernel': inventory.kernel, 'nics': sorted(inventory.nic)}
+
+    @staticmethod
+    def _load_device_tables() -> dict:
+        path = os.path.join(config.config_dir(), DEVICE_TABLE_FILE)
+        try:
+            with open(path) as device_table_file:
+                return json.load(device_table_file)
+        except (OSError, ValueError) as e:
+            log.debug(f"Cannot read bnxtmt device tables from {path}: {e}")
+            return dict()
+
+    @staticmethod
+    def _save_device_table(server_name: str, device_table: dict):
+        path = os.path.join(config.config_dir(), DEVICE_TABLE_FILE)
+        device_tables = Bnxtmt._load_device_tables()
+        device_tables[server_name] = device_table
+        try:
+            with open(path + ".tmp", 'w') as device_table_file:
+                json.dump(device_tables, device_table_file, indent=2)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            log.warning(f"Cannot save bnxtmt device tables to {path}: {e}")
+
+    def device_table(self, refresh: bool = False) -> Dict[str, int]:
+        """
+        Return the bnxtmt device numbers of the server by PCI BDF, in the bnxtmt format 00:65:00:00.
+
+        bnxtmt lists the devices when it starts, so reading the table costs a bnxtmt launch. The table is cached in
+        memory and in the client config directory, by server name. A cached table is only used while the kernel and
+        the NICs in the inventory of the server are the same as when it was read.
+
+        :param refresh: ignore the cached table and read it from bnxtmt
+        """
+        key = self._device_table_key()
+        device_table = _device_tables.get(self.server.name)
+        if device_table is None:
+            device_table = self._load_device_tables().get(self.server.name)
+        if not refresh and device_table is not None and device_table['key'] == key:
+            _device_tables[self.server.name] = device_table
+            return device_table['devices']
+        log.debug(f"Reading bnxtmt device table on server {self.server.name}.")
+        if not self.session.active:
+            self.session.start()
+        devices = dict()
+        for line in self.session.startup_lines:
+            match = re.match(r'(\d+)\s+:.*\s+([0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2})\s+', line.strip())
+            if match:
+                devices[match.group(2)] = int(match.group(1))
+        device_table = {'key': key, 'devices': devices}
+        _device_tables[self.server.name] = device_table
+        self._save_device_table(self.server.name, device_table)
+        return devices
+
     def get_device_num(self, pci_bdf: str) -> int:
         """Given a PCI addresss, return the corresponding bnxtmt device number"""
         pci_bdf_parts = re.split(f':|\.', pci_bdf)
@@ -70,19 +401,13 @@ class Bnxtmt:
         device = int(pci_bdf_parts[2], 16)
         function = int(pci_bdf_parts[3], 16)
         pci_bdf = f"{domain:02X}:{bus:02X}:{device:02X}:{function:02X}"
-        log.debug(f"Searching for {pci_bdf} in bnxtmt output.")
-        self.killall()
-        script = f'''
-            cd {self.path}
-            ./load.sh -eval " "
-            exit
-        '''
-        lines = self.server.run_script(script)
-        for line in lines:
-            line = line.strip()
-            match = re.match(rf'(\d+)\s+:.*\s+{pci_bdf}\s+', line)
-            if match:
-                return int(match.group(1))
+        log.debug(f"Searching for {pci_bdf} in bnxtmt device table.")
+        devices = self.device_table()
+        if pci_bdf not in devices:
+            # The table may have been cached before the device showed up
+            devices = self.device_table(refresh=True)
+        if pci_bdf in devices:
+            return devices[pci_bdf]
         raise ValueError(f"Cannot find bnxtmt device number for PCI BDF {pci_bdf} on server {self.server.name}")
 
     def install_pkg(self, pkg_file_name: str, nic: Nic):
@@ -123,13 +448,10 @@ class Bnxtmt:
         :return: None
         """
         log.debug(f"Remote package file name = {pkg_file_name}")
-        self.killall()
-        script = f'''
-            cd {self.path}
-            ./load.sh -eval "device {nic.bnxtmt_device}; nvm pkginstall {pkg_file_name}; reset all"
-            exit
-        '''
-        lines = self.server.run_script(script)
+        batch = self.batch(nic)
+        batch.add(f"nvm pkginstall {pkg_file_name}")
+        batch.add("reset all")
+        lines = [line for result in batch.run(timeout=1800) for line in result]
         failed = True
         for line in lines:
             line = line.lower()
@@ -147,13 +469,10 @@ class Bnxtmt:
 
         :param nic: NIC to be reset.
         """
-        self.killall()
-        script = f'''
-            cd {self.path}
-            ./load.sh -eval "device {nic.bnxtmt_device}; reset all"
-            exit
-        '''
-        lines = self.server.run_script(script)
+        self._check_reset(nic, self.session.run("reset all", nic.bnxtmt_device))
+
+    def _check_reset(self, nic: Nic, lines: List[str]):
+        """Raise IOError if the output of 'reset all' does not show the reset completed."""
         failed = True
         for line in lines:
             line = line.lower()
@@ -170,24 +489,15 @@ class Bnxtmt:
 
         :param nic: NIC to reset to factory default
         """
-        self.killall()
         dir_entry = self.get_sys_cfg_entry(nic)
-        script = f'''
-            cd {self.path}
-            ./load.sh -eval "device {nic.bnxtmt_device}; nvm erase {dir_entry}"
-            exit
-        '''
-        self.server.run_script(script)
-        self.reset_all(nic)
+        batch = self.batch(nic)
+        batch.add(f"nvm erase {dir_entry}")
+        reset = batch.add("reset all")
+        self._check_reset(nic, batch.run()[reset])
 
     def get_sys_cfg_entry(self, nic: Nic):
         """Return directory entry number for SYS_CFG"""
-        script = f'''
-            cd {self.path}
-            ./load.sh -eval "device {nic.bnxtmt_device}; nvm dir"
-            exit
-        '''
-        lines = self.server.run_script(script)
+        lines = self.session.run("nvm dir", nic.bnxtmt_device, retry=True)
         for line in lines:
             match = re.match(r'\s*(\d+)\s+SYS_CFG\s+', line)
             if match:
@@ -199,12 +509,7 @@ class Bnxtmt:
 
     def unlock_grc(self, nic: Nic):
         """Unlock the PCIE BAR for write access."""
-        script = f'''
-            cd {self.path}
-            ./load.sh -eval "device {nic.bnxtmt_device}; unlock grc"
-            exit
-        '''
-        lines = self.server.run_script(script)
+        lines = self.session.run("unlock grc", nic.bnxtmt_device, retry=True)
         for line in lines:
             if "GRCP already unlocked" in line or "unlocked GRCP" in line:
                 return
@@ -215,7 +520,14 @@ class Bnxtmt:
         self.unload_driver()
         sys.exit(1)
 
-    def primate_trace(self, nic: Nic, tail: bool = False):
+    def primate_trace(self, nic: Nic, tail: bool = False, poll_interval: float = 1.0):
+        """
+        Print the primate trace of the NIC.
+
+        :param nic: NIC to dump the trace of
+        :param tail: keep polling the trace and print new lines, like 'tail -f'
+        :param poll_interval: seconds between polls when tail is set
+        """
         signal.signal(signal.SIGTERM, self._sigterm_cleanup)
         self.killall()
         self.unload_driver()
@@ -223,46 +535,22 @@ class Bnxtmt:
         if not tail:
             print("\n".join(self._get_primate_trace(nic)))
             return
-        exp = self.server.get_expect_session()
-        exp.sendline(f"cd {self.path}")
-        exp.expect(self.server.prompt)
-        exp.sendline(f"./load.sh")
-        exp.delaybeforesend = None
-
-        exp.expect_exact(prompt(1))
-        slow_sendline(exp, f"device {nic.bnxtmt_device}")
         try:
             while True:
-                exp.expect_exact(prompt(nic.bnxtmt_device))
-                self._echo_trace(exp.before)
-                slow_sendline(exp, f"primate trace")
+                self._echo_trace("\n".join(self.session.run("primate trace", nic.bnxtmt_device)))
+                sleep(poll_interval)
         except Timeout:
-            exp.close()
+            self.killall()
             log.critical("Timed out waiting on bnxtmt.")
             sys.exit(1)
 
     def _echo_trace(self, buffer: str):
-        buffer = buffer.strip()
-        if not buffer:
-            return
-        if self._last_buffer_hash is not None and self._last_buffer_hash == hash(buffer):
-            # Buffer hasn't changed since last poll, nothing to do
-            return
-        self._last_buffer_hash = hash(buffer)
-        buffer = buffer.splitlines()
-        if not self._trace_buffer:
-            self._trace_buffer = copy(buffer)
-        else:
-            new_trace_buffer = []
-            for line in reversed(buffer):
-                if line == self._trace_buffer[-1]:
-                    break
-                new_trace_buffer.insert(0, line)
-            self._trace_buffer = new_trace_buffer
-        for line in self._trace_buffer:
-            match = re.match(r"\d+\.\d+:", line)
-            if match:
-                print(line)
+        """Print the trace lines that are new since the last poll."""
+        lines, gap = self._trace_delta.new_lines(buffer)
+        if gap:
+            log.warning("Primate trace lines were lost between polls. Use a shorter poll interval.")
+        for line in lines:
+            print(line)
 
     def _get_primate_trace(self, nic: Nic):
         script = f'''
@@ -134,6 +134,28 @@ def poll(func: Callable, *args, expected: Any = True, max_wait: float = 300.0,
     return False
 
 
+class AdaptivePoller:
+    """
+    Sleep between polls for an interval that follows how often new data shows up.
+
+    The interval is halved each time a poll finds new data, down to min_interval, and grows by half each time a poll
+    comes up empty, up to max_interval. A busy source is polled quickly, an idle one is left alone.
+    """
+
+    def __init__(self, min_interval: float = 0.01, max_interval: float = 0.5, interval: float = 0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = interval
+
+    def wait(self, found_data: bool):
+        """Adjust the interval based on the result of the last poll, then sleep for it."""
+        if found_data:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+        time.sleep(self.interval)
+
+
 def setup_logging(log, verbosity, stream=sys.stdout):
     logging.raiseExceptions = False
     log.setLevel(verbosity)
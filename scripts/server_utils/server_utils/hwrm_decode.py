@@ -0,0 +1,221 @@
+"""
+Decode and print HWRM messages from the primate HWRM history.
+
+Used by the hwrm script for live output and by the hwrm_decode script for captures. Requires the hwrm module, which
+is only installed on the client.
+"""
+import logging
+from collections import deque
+from ctypes import sizeof
+from functools import lru_cache
+from multiprocessing import Pool
+from struct import Struct
+
+from hwrm import HwrmCmdHdr, HwrmRespHdr, get_class, HwrmReqType, HwrmErrOutput, HwrmExecFwdRespInput
+
+from server_utils.config import config
+from server_utils.nitro.hwrm_msg_compact import HwrmMsgCompact, RECORD, unpack
+
+log = logging.getLogger(__name__)
+msg_cnt = 0
+
+HDR_FIELD = Struct('<H')
+# Offsets of the header fields in the raw message bytes. req_type is keyed by request.
+REQ_TYPE_OFFSET = {
+    True: HwrmCmdHdr()._cstruct_type.req_type.offset,
+    False: HwrmRespHdr()._cstruct_type.req_type.offset,
+}
+REQ_SEQ_ID_OFFSET = HwrmCmdHdr()._cstruct_type.seq_id.offset
+RESP_SEQ_ID_OFFSET = HwrmRespHdr()._cstruct_type.seq_id.offset
+RESP_ERROR_CODE_OFFSET = HwrmRespHdr()._cstruct_type.error_code.offset
+# The hwrm classes only depend on req_type and direction, so look them up once
+get_class = lru_cache(maxsize=None)(get_class)
+# Lower case include and exclude strings, see get_filter()
+_filter = None
+# Filter result by req_type. Filled in as message types are seen.
+_enabled = dict()
+
+
+def get_hwrm_type(hwrm_msg):
+    return HDR_FIELD.unpack_from(hwrm_msg.bytes, REQ_TYPE_OFFSET[bool(hwrm_msg.request)])[0]
+
+
+def get_hwrm_header(hwrm_msg):
+    """Return the req_type, seq_id and error_code of the message. error_code is None for requests."""
+    if hwrm_msg.request:
+        return get_hwrm_type(hwrm_msg), HDR_FIELD.unpack_from(hwrm_msg.bytes, REQ_SEQ_ID_OFFSET)[0], None
+    return get_hwrm_type(hwrm_msg), HDR_FIELD.unpack_from(hwrm_msg.bytes, RESP_SEQ_ID_OFFSET)[0], \
+        HDR_FIELD.unpack_from(hwrm_msg.bytes, RESP_ERROR_CODE_OFFSET)[0]
+
+
+def get_filter():
+    """Return the lower case include and exclude strings. The config is read only once."""
+    if _filter is None:
+        set_filter(config['hwrm_include'].get(list), config['hwrm_exclude'].get(list))
+    return _filter
+
+
+def set_filter(includes, excludes):
+    global _filter
+    _filter = [include.lower() for include in includes], [exclude.lower() for exclude in excludes]
+    _enabled.clear()
+
+
+def match_filter(req_type):
+    includes, excludes = get_filter()
+    if not includes and not excludes:
+        return True
+    req_type = str(HwrmReqType(req_type)).lower()
+    if includes:
+        for include in includes:
+            if include in req_type:
+                return True
+        return False
+    for exclude in excludes:
+        if exclude in req_type:
+            return False
+    return True
+
+
+def is_enabled(req_type):
+    enabled = _enabled.get(req_type)
+    if enabled is None:
+        enabled = _enabled[req_type] = match_filter(req_type)
+    return enabled
+
+
+def decode_hwrm_msg(hwrm_msg):
+    """
+    Decode a message to text. Returns None if the message is filtered out.
+
+    The text is returned as (head, tail). The message number is printed between the two, so messages can be decoded
+    in any order and numbered when they are printed. tail is None if the message is not numbered.
+    """
+    if hwrm_msg.dropped:
+        return f"HWRM history ring overrun. At least {hwrm_msg.dropped} messages were dropped.", None
+    req_type = get_hwrm_type(hwrm_msg)
+    buffer = ""
+    if is_enabled(req_type):
+        if hwrm_msg.request:
+            msg_type = "REQUEST"
+        else:
+            msg_type = "RESPONSE"
+        hwrm_class = get_class(req_type, not hwrm_msg.request)
+        hwrm_req_resp = hwrm_class()
+        cstruct_type = hwrm_req_resp._cstruct_type
+        buffer_size = len(hwrm_msg.bytes)
+        if sizeof(cstruct_type) > buffer_size:
+            # The HWRM debug buffers are only 128 bytes. Some HWRM messages are larger than 128. Pad out bytes with
+            # zeros.
+            pad_size = sizeof(cstruct_type) - buffer_size
+            for _ in range(pad_size):
+                hwrm_msg.bytes.append(0)
+            buffer += f"WARNING: Only first {buffer_size} bytes are valid. Message was truncated.\n"
+        hwrm_req_resp.cstruct = cstruct_type.from_buffer(hwrm_msg.bytes)
+        hwrm_req_resp.copy_from_cstruct()
+        if not hwrm_msg.request and hwrm_req_resp.hwrm_resp_hdr.error_code != 0:
+            # Error response, so cast to hwrm_err_output
+            hwrm_req_resp = HwrmErrOutput()
+            hwrm_req_resp.cstruct = hwrm_req_resp._cstruct_type.from_buffer(hwrm_msg.bytes)
+            hwrm_req_resp.copy_from_cstruct()
+            msg_type += " ERROR"
+        head = buffer
+        buffer = f" - {hwrm_msg.index + 1}/{hwrm_msg.max_entries} {msg_type}  " + \
+                 f"time: {hwrm_msg.time} chan:{hwrm_msg.channel}\n"
+        buffer += str(hwrm_req_resp)
+        if hwrm_msg.request and isinstance(hwrm_req_resp, HwrmExecFwdRespInput):
+            # If this is a forwarded request, decode the encapsulated request.
+            hwrm_msg = HwrmMsgCompact()
+            hwrm_msg.request = True
+            hwrm_msg.bytes = bytearray(hwrm_req_resp.cstruct.encap_request)
+            req_type = get_hwrm_type(hwrm_msg)
+            hwrm_class = get_class(req_type, False)
+            hwrm_req_resp = hwrm_class()
+            cstruct_type = hwrm_req_resp._cstruct_type
+            #buffer_size = len(hwrm_msg.bytes)
+            #if sizeof(cstruct_type) > buffer_size:
+            #    # The HWRM debug buffers are only 128 bytes. Some HWRM messages are larger than 128. Pad out bytes with
+            #    # zeros.
+            #    pad_size = sizeof(cstruct_type) - buffer_size
+            #    for _ in range(pad_size):
+            #        hwrm_msg.bytes.append(0)
+            #    buffer += f"WARNING: Only first {buffer_size} bytes are valid. Message was truncated.\n"
+            hwrm_req_resp.cstruct = cstruct_type.from_buffer(hwrm_msg.bytes)
+            hwrm_req_resp.copy_from_cstruct()
+            if not hwrm_msg.request and hwrm_req_resp.hwrm_resp_hdr.error_code != 0:
+                # Error response, so cast to hwrm_err_output
+                hwrm_req_resp = HwrmErrOutput()
+                hwrm_req_resp.cstruct = hwrm_req_resp._cstruct_type.from_buffer(hwrm_msg.bytes)
+                hwrm_req_resp.copy_from_cstruct()
+                msg_type += " ERROR"
+            buffer += f"\n\nEncapsulated REQUEST\n"
+            encap_req_str = str(hwrm_req_resp)
+            for line in encap_req_str.splitlines():
+                buffer += f"    {line}\n"
+        return head, buffer
+    return None
+
+
+def print_decoded(decoded, device: str = None):
+    """Print a message returned by decode_hwrm_msg(), numbering it. If given, the device is printed after the number."""
+    global msg_cnt
+    if decoded is None:
+        return
+    head, tail = decoded
+    print("\n" + "=" * 80)
+    if tail is None:
+        print(f"{device}: {head}" if device else head)
+        return
+    device = f" {device}" if device else ""
+    print(f"{head}#{msg_cnt:06d}{device}{tail}")
+    msg_cnt += 1
+
+
+def print_hwrm_msg(hwrm_msg, device: str = None):
+    print_decoded(decode_hwrm_msg(hwrm_msg), device)
+
+
+def decode_batch(batch):
+    """Decode a batch of packed records. Runs in a HwrmDecodePool worker."""
+    return [decode_hwrm_msg(hwrm_msg) for hwrm_msg in unpack(batch)]
+
+
+class HwrmDecodePool:
+    """
+    Decode batches of HWRM messages in worker processes and print them in the order they were added.
+
+        decode_pool = HwrmDecodePool()
+        decode_pool.add(batch)
+        decode_pool.print_done()
+        ...
+        decode_pool.close()
+    """
+    # Records per worker task. Large batches, such as the first read of the ring, are split across the workers.
+    CHUNK_RECORDS = 32
+
+    def __init__(self, processes: int = None):
+        """
+        :param processes: number of worker processes. Defaults to the number of CPUs.
+        """
+        # The workers get the filter from here, since they might not share the config of this process.
+        self.pool = Pool(processes, initializer=set_filter, initargs=get_filter())
+        self.pending = deque()
+
+    def add(self, batch: bytes, device: str = None):
+        """Queue a batch of packed records for decoding. If given, the device is printed with each message."""
+        chunk_size = RECORD.size * self.CHUNK_RECORDS
+        for offset in range(0, len(batch), chunk_size):
+            self.pending.append((self.pool.apply_async(decode_batch, [batch[offset:offset + chunk_size]]), device))
+
+    def print_done(self, wait: bool = False):
+        """Print decoded messages in order, stopping at the first batch that is not decoded yet unless wait is set."""
+        while self.pending and (wait or self.pending[0][0].ready()):
+            result, device = self.pending.popleft()
+            for decoded in result.get():
+                print_decoded(decoded, device)
+
+    def close(self):
+        """Print all remaining messages and stop the workers."""
+        self.print_done(wait=True)
+        self.pool.close()
+        self.pool.join()
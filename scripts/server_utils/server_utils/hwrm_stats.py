@@ -0,0 +1,128 @@
+"""
+HWRM request/response latency analytics from the primate HWRM history.
+
+Each request is paired with its response by channel, req_type and seq_id, and the counts, error rates and latencies are
+aggregated per req_type. Latency is measured with the history time stamps, so it has a resolution of 100ms.
+
+    hwrm_stats = HwrmStats()
+    for hwrm_msg in hwrm_msgs:
+        hwrm_stats.add(hwrm_msg)
+    print(hwrm_stats.summary())
+    hwrm_stats.reset()
+"""
+from hwrm import HwrmReqType
+
+from server_utils.hwrm_decode import get_hwrm_header, is_enabled
+
+
+class ReqTypeStats:
+    # Upper bounds of the latency histogram buckets, in 100ms time stamp units. The last bucket has no bound.
+    BUCKETS = (0, 1, 2, 5, 10, 50)
+
+    def __init__(self):
+        self.requests = 0
+        self.responses = 0
+        self.errors = 0
+        # Responses paired with their request
+        self.paired = 0
+        self.latency_sum = 0
+        self.latency_max = 0
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+
+    def add_latency(self, latency: int):
+        self.paired += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        for bucket, bound in enumerate(self.BUCKETS):
+            if latency <= bound:
+                self.histogram[bucket] += 1
+                return
+        self.histogram[-1] += 1
+
+
+class HwrmStats:
+    def __init__(self, max_pending_age: int = 600):
+        """
+        :param max_pending_age: time stamp units, 100ms each, after which a request still waiting for a response is
+                                counted as unanswered. seq_id is only 16 bits, so without a bound, a late response could
+                                pair with a much older request.
+        """
+        self.max_pending_age = max_pending_age
+        # Requests waiting for a response, oldest first. (channel, req_type, seq_id) -> request time stamp
+        self.pending = dict()
+        self.reset()
+
+    def reset(self):
+        """Start a new window. Requests still waiting for a response are kept."""
+        # req_type -> ReqTypeStats
+        self.req_types = dict()
+        self.unmatched = 0
+        self.unanswered = 0
+        self.dropped = 0
+
+    def _req_type_stats(self, req_type: int) -> ReqTypeStats:
+        stats = self.req_types.get(req_type)
+        if stats is None:
+            stats = self.req_types[req_type] = ReqTypeStats()
+        return stats
+
+    def add(self, hwrm_msg):
+        """Add a message from the HWRM history. Messages must be added in ring order."""
+        if hwrm_msg.dropped:
+            # The responses of pending requests may have been dropped, so they can no longer be paired reliably.
+            self.dropped += hwrm_msg.dropped
+            self.pending.clear()
+            return
+        self._expire(hwrm_msg.time_stamp)
+        req_type, seq_id, error_code = get_hwrm_header(hwrm_msg)
+        if not is_enabled(req_type):
+            return
+        if hwrm_msg.request:
+            self._req_type_stats(req_type).requests += 1
+            key = (hwrm_msg.channel, req_type, seq_id)
+            # Re-insert, so the pending requests stay in time order
+            self.pending.pop(key, None)
+            self.pending[key] = hwrm_msg.time_stamp
+            return
+        stats = self._req_type_stats(req_type)
+        stats.responses += 1
+        if error_code != 0:
+            stats.errors += 1
+        request_time_stamp = self.pending.pop((hwrm_msg.channel, req_type, seq_id), None)
+        if request_time_stamp is None:
+            # The request was before the start of the history, or was dropped.
+            self.unmatched += 1
+            return
+        stats.add_latency(hwrm_msg.time_stamp - request_time_stamp)
+
+    def _expire(self, time_stamp: int):
+        """Drop the pending requests older than max_pending_age and count them as unanswered."""
+        while self.pending:
+            key, request_time_stamp = next(iter(self.pending.items()))
+            if time_stamp - request_time_stamp <= self.max_pending_age:
+                return
+            del self.pending[key]
+            self.unanswered += 1
+
+    def summary(self, title: str = "HWRM summary") -> str:
+        """Return a table of the counts, error rates and latencies per req_type since the last reset()."""
+        buckets = [f"<={bound / 10:.1f}s" for bound in ReqTypeStats.BUCKETS]
+        buckets.append(f">{ReqTypeStats.BUCKETS[-1] / 10:.1f}s")
+        requests = sum(stats.requests for stats in self.req_types.values())
+        paired = sum(stats.paired for stats in self.req_types.values())
+        lines = ["\n" + "=" * 80,
+                 f"{title}: {requests} requests, {paired} paired responses, {self.unmatched} unmatched responses, "
+                 f"{self.unanswered} unanswered, {len(self.pending)} waiting, {self.dropped} dropped",
+                 f"{'req_type':<28} {'requests':>8} {'errors':>7} {'error%':>6} {'mean(s)':>7} {'max(s)':>6} " +
+                 " ".join(f"{bucket:>7}" for bucket in buckets)]
+        # Busiest first
+        for req_type, stats in sorted(self.req_types.items(), key=lambda item: -item[1].requests):
+            try:
+                name = str(HwrmReqType(req_type))
+            except ValueError:
+                name = f"0x{req_type:04x}"
+            error_rate = 100.0 * stats.errors / stats.responses if stats.responses else 0.0
+            mean = stats.latency_sum / stats.paired / 10 if stats.paired else 0.0
+            lines.append(f"{name:<28} {stats.requests:>8} {stats.errors:>7} {error_rate:>6.1f} {mean:>7.2f} "
+                         f"{stats.latency_max / 10:>6.1f} " + " ".join(f"{count:>7}" for count in stats.histogram))
+        return "\n".join(lines)
@@ -0,0 +1,119 @@
+"""
+Indexed on-disk store of HWRM history messages.
+
+Messages are kept in a SQLite database, one row per message, with the raw 128 byte message as a blob. The header
+fields are stored in indexed columns, so a query such as all FUNC_CFG errors on channel 3 in the last hour only reads
+the matching rows, even on stores with millions of messages. The rows are decoded with hwrm_decode when printed.
+"""
+import sqlite3
+import time
+from typing import Iterator, List
+
+from server_utils.hwrm_decode import get_hwrm_header
+from server_utils.nitro.hwrm_msg_compact import HwrmMsgCompact
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hwrm (
+    id INTEGER PRIMARY KEY,
+    -- Host time the message was captured, in seconds since the epoch
+    host_time REAL NOT NULL,
+    -- Firmware time stamp in 100ms units
+    time_stamp INTEGER NOT NULL,
+    ring_index INTEGER NOT NULL,
+    max_entries INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    request INTEGER NOT NULL,
+    req_type INTEGER,
+    seq_id INTEGER,
+    -- NULL for requests
+    error_code INTEGER,
+    -- Non-zero if the row is not a message, but a report of this many dropped messages
+    dropped INTEGER NOT NULL DEFAULT 0,
+    msg BLOB
+);
+CREATE INDEX IF NOT EXISTS hwrm_host_time ON hwrm (host_time);
+CREATE INDEX IF NOT EXISTS hwrm_req_type ON hwrm (req_type, host_time);
+CREATE INDEX IF NOT EXISTS hwrm_channel ON hwrm (channel, host_time);
+CREATE INDEX IF NOT EXISTS hwrm_seq_id ON hwrm (seq_id);
+CREATE INDEX IF NOT EXISTS hwrm_error_code ON hwrm (error_code) WHERE error_code != 0;
+"""
+COLUMNS = "host_time, time_stamp, ring_index, max_entries, channel, request, req_type, seq_id, error_code, dropped, msg"
+
+
+class HwrmStore:
+    def __init__(self, path: str):
+        """Open the store, creating it if needed."""
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # Appends are much faster with a write-ahead log, and readers do not block the capture.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def add(self, hwrm_msgs: List[HwrmMsgCompact], host_time: float = None):
+        """Store a batch of messages, stamped with the host time they were captured."""
+        if host_time is None:
+            host_time = time.time()
+        rows = []
+        for hwrm_msg in hwrm_msgs:
+            if hwrm_msg.dropped:
+                rows.append((host_time, 0, 0, hwrm_msg.max_entries, 0, 0, None, None, None, hwrm_msg.dropped, None))
+                continue
+            req_type, seq_id, error_code = get_hwrm_header(hwrm_msg)
+            rows.append((host_time, hwrm_msg.time_stamp, hwrm_msg.index, hwrm_msg.max_entries, hwrm_msg.channel,
+                         int(hwrm_msg.request), req_type, seq_id, error_code, 0, bytes(hwrm_msg.bytes)))
+        with self.db:
+            self.db.executemany(f"INSERT INTO hwrm ({COLUMNS}) VALUES ({', '.join('?' * 11)})", rows)
+
+    def req_types(self) -> List[int]:
+        """Return the req_types in the store."""
+        return [row[0] for row in self.db.execute("SELECT DISTINCT req_type FROM hwrm WHERE req_type IS NOT NULL")]
+
+    def query(self, req_types: List[int] = None, channels: List[int] = None, seq_ids: List[int] = None,
+              errors: bool = False, since: float = None, until: float = None,
+              limit: int = None) -> Iterator[HwrmMsgCompact]:
+        """
+        Yield the matching messages in the order they were captured.
+
+        Reports of dropped messages are included only if no message filter is given.
+
+        :param req_types: only these req_types. Both requests and responses are included.
+        :param channels: only these HWRM channels
+        :param seq_ids: only these sequence IDs
+        :param errors: only error responses
+        :param since: only messages captured at or after this host time
+        :param until: only messages captured before this host time
+        :param limit: at most this many rows
+        """
+        where = []
+        params = []
+        for column, values in [("req_type", req_types), ("channel", channels), ("seq_id", seq_ids)]:
+            if values is not None:
+                where.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params += values
+        if errors:
+            where.append("error_code != 0")
+        if where:
+            where.append("dropped = 0")
+        if since is not None:
+            where.append("host_time >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("host_time < ?")
+            params.append(until)
+        sql = f"SELECT {COLUMNS} FROM hwrm"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY host_time, id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        for host_time, time_stamp, ring_index, max_entries, channel, request, req_type, seq_id, error_code, \
+                dropped, msg in self.db.execute(sql, params):
+            if dropped:
+                yield HwrmMsgCompact(max_entries=max_entries, dropped=dropped)
+                continue
+            yield HwrmMsgCompact(ring_index, max_entries, bool(request), bytearray(msg), channel, time_stamp)
+
+    def close(self):
+        self.db.close()
@@ -41,6 +41,8 @@ class Inventory(ABC):
         self._packages = None
         self._swap = None
         self._pci_configuration_header = {}
+        # Command -> output lines, run ahead of time by prefetch()
+        self._prefetched = dict()
 
     def all_properties(self):
         """
@@ -66,9 +68,12 @@ class Inventory(ABC):
             'os',
             'packages',
         ]
+        self.prefetch()
         for prop_name in props:
             prop = getattr(self, prop_name)
             inventory[prop_name] = prop
+        # Do not keep output that no property used, it would be stale by the time a property reads it
+        self._prefetched = dict()
         # Add some additional detail for ethernet interfaces
         for ethernet_interface in self.ethernet_interfaces:
             d = dict(
@@ -97,6 +102,23 @@ class Inventory(ABC):
         self._nic = None
         self._packages = None
         self._swap = None
+        self._prefetched = dict()
+
+    # Commands of the cached properties, and the attribute each one fills. prefetch() runs them all at once.
+    PREFETCH_COMMANDS = {}
+
+    def prefetch(self):
+        """
+        Run the commands of the cached properties concurrently on the server, so collecting the whole inventory costs
+        about one round trip instead of one per command. The output of each command is used once, by the next cli()
+        call with the same command. Commands of properties that are already cached are skipped, and commands that fail
+        are left to run again when their property is read.
+        """
+        commands = [command for command, attribute in self.PREFETCH_COMMANDS.items()
+                    if command not in self._prefetched and not getattr(self, attribute)]
+        for command, (stdout, _, exit_status) in zip(commands, self.server.exec_all(commands)):
+            if exit_status == 0:
+                self._prefetched[command] = stdout
 
     def cli(self, command: str, check: bool = False, **kwargs) -> str:
         """
@@ -105,6 +127,8 @@ class Inventory(ABC):
         :param command: Command to execute on local or remote cli
         :param check: If true, raise exception on non-zero exit status
         """
+        if command in self._prefetched:
+            return "\n".join(self._prefetched.pop(command))
         return "\n".join(self._cli(command, check=check, **kwargs))
 
     @property
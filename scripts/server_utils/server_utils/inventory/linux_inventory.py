@@ -9,6 +9,22 @@ log = logging.getLogger(__name__)
 
 
 class LinuxInventory(Inventory):
+    PREFETCH_COMMANDS = {
+        'lscpu': '_cpu',
+        'cat /proc/cmdline': '_cmdline',
+        "cat /etc/*-release": '_distribution',
+        "env": '_env',
+        "for mod in `lsmod | sed -n '1!p' | cut -f1 -d ' '`; do echo $mod `modinfo -F version $mod`; done;":
+            '_drivers',
+        'hostname -f': '_hostname',
+        'ls -la /sys/class/net/': '_interfaces',
+        'ip addr show': '_interfaces',
+        'uname -r': '_kernel',
+        'cat /proc/meminfo': '_memory',
+        "lsblk -o KNAME,TYPE,MOUNTPOINT": '_mounts',
+        "df": '_mounts',
+        "lspci -Dvv": '_nic',
+    }
 
     @property
     def cpu(self) -> Dict[str, Union[str, float, int]]:
@@ -0,0 +1,290 @@
+"""
+Micro-benchmarks for the nitro register access and decode paths.
+
+The benchmarks run against SimulatedBar0, so no hardware is needed. They measure the Python cost of each path, not
+PCIe latency.
+
+    python3 -m server_utils.nitro.benchmark [-n REPEAT] [benchmark ...]
+"""
+import argparse
+import io
+import sys
+from contextlib import redirect_stdout
+from ctypes import sizeof
+from queue import SimpleQueue
+from struct import pack_into
+from threading import Thread
+from timeit import timeit
+
+from server_utils.nitro.address import firmware_to_host_addr
+from server_utils.nitro.grc import GRCRegisterAccess
+from server_utils.nitro.hwrm_history import HwrmHistory, HwrmHistEntryStruct
+from server_utils.nitro.hwrm_msg_compact import unpack
+from server_utils.nitro.simulated_bar0 import SimulatedBar0
+from server_utils.nitro.trace import Trace
+
+SIM_BDF = "ffff:00:00.0"
+
+
+def simulated_grc(backend: SimulatedBar0 = None, pci_bdf: str = SIM_BDF) -> GRCRegisterAccess:
+    """Return a GRCRegisterAccess on a simulated BAR. By default, 68KB at 0x20000000 is filled with a byte pattern."""
+    if backend is None:
+        backend = SimulatedBar0()
+        backend.write(0x20000000, bytes(i & 0xff for i in range(0x11000)))
+    return GRCRegisterAccess(pci_bdf, backend)
+
+
+def seeded_bar() -> SimulatedBar0:
+    """Return a simulated BAR with a full trace ring and a full HWRM history ring."""
+    backend = SimulatedBar0()
+    backend.seed()
+    line = 0
+    text = b""
+    while len(text) < 0x8000:
+        text += f"{line / 10:.1f}: simulated firmware trace line {line}\n".encode()
+        line += 1
+    backend.append_trace(text)
+    for i in range(255):
+        backend.add_hwrm_entry(bytes((i + n) & 0xff for n in range(128)), channel=i % 4, request=bool(i % 2))
+    return backend
+
+
+# A mix of HWRM message types: ver_get, func_qcaps, func_qcfg, port_phy_cfg, port_phy_qcfg and ring_alloc
+HWRM_REQ_TYPES = (0x0, 0x15, 0x16, 0x20, 0x27, 0x50)
+
+
+def hwrm_header(req_type: int, seq_id: int, request: bool, error_code: int = 0) -> bytes:
+    """Return a 128 byte HWRM message with only the request or response header filled in."""
+    msg = bytearray(HwrmHistEntryStruct.REQ_SIZE)
+    if request:
+        # req_type, cmpl_ring, seq_id, target_id
+        pack_into('<HHHH', msg, 0, req_type, 0xffff, seq_id, 0xffff)
+    else:
+        # error_code, req_type, seq_id, resp_len
+        pack_into('<HHHH', msg, 0, error_code, req_type, seq_id, 16)
+    return bytes(msg)
+
+
+def hwrm_bar(num_pairs: int = 127) -> SimulatedBar0:
+    """Return a simulated BAR whose HWRM history holds request and response pairs of mixed types."""
+    backend = SimulatedBar0()
+    backend.seed()
+    for i in range(num_pairs):
+        req_type = HWRM_REQ_TYPES[i % len(HWRM_REQ_TYPES)]
+        channel = i % 4
+        backend.add_hwrm_entry(hwrm_header(req_type, i, True), channel=channel)
+        backend.add_hwrm_entry(hwrm_header(req_type, i, False), channel=channel, request=False)
+    return backend
+
+
+def report(name: str, number: int, results: dict):
+    """Print the time per call of each variant, relative to the first one."""
+    baseline = None
+    for variant, seconds in results.items():
+        per_call = seconds / number
+        if baseline is None:
+            baseline = per_call
+        print(f"{name:<24} {variant:<12} {per_call * 1e3:10.3f} ms/call {baseline / per_call:8.1f}x")
+
+
+def bench_read_bytes(number: int):
+    """Compare the byte-at-a-time and bulk GRC read paths on an unaligned 64 KB read."""
+    grc = simulated_grc()
+    addr = 0x20000003
+    num_bytes = 0x10000
+    if grc.read_bytes(addr, num_bytes, bulk=False) != grc.read_bytes(addr, num_bytes):
+        raise AssertionError("Bulk read does not match byte-at-a-time read.")
+    report("read_bytes(64K)", number, {
+        'by_byte': timeit(lambda: grc.read_bytes(addr, num_bytes, bulk=False), number=number),
+        'bulk': timeit(lambda: grc.read_bytes(addr, num_bytes), number=number),
+    })
+
+
+def stress_grc_locks(grc: GRCRegisterAccess, num_threads: int, number: int, base: int):
+    """
+    Have several threads write and read back overlapping byte ranges through one GRCRegisterAccess.
+
+    Each thread owns an unaligned 7-byte range, so neighbouring threads read-modify-write the same words. Without the
+    window lock, those updates would be lost.
+    """
+    errors = []
+
+    def worker(thread_num):
+        addr = base + thread_num * 7
+        for i in range(number * 100):
+            data = bytes((thread_num + i + n) & 0xff for n in range(7))
+            grc.write_bytes(addr, data)
+            # write_bytes() stores data last byte first
+            if grc.read_bytes(addr, len(data)) != data[::-1]:
+                errors.append(f"{grc.pci_bdf} thread {thread_num}: read back mismatch at 0x{addr:08x}")
+                return
+
+    threads = [Thread(target=worker, args=[i]) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def bench_device_locks(number: int):
+    """Stress GRC access from several threads against two fake devices, each with two readers."""
+    grcs = []
+    for pci_bdf in ["ffff:01:00.0", "ffff:02:00.0"]:
+        backend = SimulatedBar0()
+        grcs += [simulated_grc(backend, pci_bdf) for _ in range(2)]
+    num_threads = 8
+    errors = []
+
+    def run():
+        # Readers of the same device use separate pages, since the simulated windows are not coherent.
+        threads = [Thread(target=lambda grc=grc, base=0x1ffc + i * 0x4000:
+                          errors.extend(stress_grc_locks(grc, num_threads, number, base)))
+                   for i, grc in enumerate(grcs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    report("device_locks", 1, {'threads': timeit(run, number=1)})
+    for error in errors:
+        print(error)
+    if errors:
+        raise AssertionError(f"{len(errors)} threads read back corrupted data.")
+
+
+def bench_trace(number: int):
+    """Time dumping a full trace ring."""
+    trace = Trace(SIM_BDF, seeded_bar())
+    queue = SimpleQueue()
+    report("trace(32K)", number, {'trace': timeit(lambda: trace.trace(queue, False), number=number)})
+
+
+def bench_hwrm_history(number: int):
+    """Time dumping a full 255 entry HWRM history ring."""
+    hwrm_history = HwrmHistory(SIM_BDF, backend=seeded_bar())
+    queue = SimpleQueue()
+
+    def dump():
+        hwrm_history.last_index = None
+        hwrm_history.get_history(queue, False)
+
+    report("hwrm_history(255)", number, {'get_history': timeit(dump, number=number)})
+
+
+def newest_index_by_entry(bytes, max_entries):
+    """Reference implementation of HwrmHistory.get_newest_index, with one ctypes object per entry."""
+    max_timestamp = -1
+    newest_index = -1
+    for i in range(max_entries):
+        hwrm_entry = HwrmHistEntryStruct.from_buffer(bytes, sizeof(HwrmHistEntryStruct) * i)
+        if hwrm_entry.time_stamp >= max_timestamp:
+            max_timestamp = hwrm_entry.time_stamp
+            newest_index = i
+    return newest_index
+
+
+def bench_newest_index(number: int):
+    """Compare per-entry ctypes and strided newest entry detection on a 255 entry ring."""
+    max_entries = 255
+    hwrm_history = HwrmHistory(SIM_BDF, backend=seeded_bar())
+    ring = hwrm_history.grc.read_bytes(firmware_to_host_addr(SimulatedBar0.HWRM_ENTRIES_ADDR),
+                                       sizeof(HwrmHistEntryStruct) * max_entries)
+    if newest_index_by_entry(ring, max_entries) != hwrm_history.get_newest_index(ring, max_entries):
+        raise AssertionError("Strided newest index does not match per-entry newest index.")
+    number *= 100
+    report("get_newest_index(255)", number, {
+        'ctypes': timeit(lambda: newest_index_by_entry(ring, max_entries), number=number),
+        'strided': timeit(lambda: hwrm_history.get_newest_index(ring, max_entries), number=number),
+    })
+
+
+def msg_as_bytes_by_byte(hwrm_entry):
+    """Reference implementation of HwrmHistEntryStruct.msg_as_bytes, one byte at a time."""
+    bytes = bytearray()
+    for i in range(hwrm_entry.REQ_SIZE):
+        word = hwrm_entry.msg[int(i / 4)]
+        bytes.append(int((word >> (int(i % 4) * 8)) & 0xff))
+    return bytes
+
+
+def bench_msg_as_bytes(number: int):
+    """Compare byte-at-a-time and direct message conversion over a full 255 entry ring."""
+    max_entries = 255
+    ring = seeded_bar().read(firmware_to_host_addr(SimulatedBar0.HWRM_ENTRIES_ADDR),
+                             sizeof(HwrmHistEntryStruct) * max_entries)
+    entries = [HwrmHistEntryStruct.from_buffer(ring, sizeof(HwrmHistEntryStruct) * i) for i in range(max_entries)]
+    for hwrm_entry in entries:
+        if msg_as_bytes_by_byte(hwrm_entry) != hwrm_entry.msg_as_bytes:
+            raise AssertionError("msg_as_bytes does not match byte-at-a-time conversion.")
+    report("msg_as_bytes(255)", number, {
+        'by_byte': timeit(lambda: [msg_as_bytes_by_byte(hwrm_entry) for hwrm_entry in entries], number=number),
+        'direct': timeit(lambda: [hwrm_entry.msg_as_bytes for hwrm_entry in entries], number=number),
+    })
+
+
+def bench_hwrm_decode(number: int):
+    """Compare decoding a full ring of mixed HWRM messages in the main process and in a HwrmDecodePool."""
+    try:
+        from server_utils import hwrm_decode
+    except ImportError as e:
+        print(f"{'hwrm_decode':<24} skipped: {e}")
+        return
+    hwrm_history = HwrmHistory(SIM_BDF, backend=hwrm_bar())
+    queue = SimpleQueue()
+    hwrm_history.get_history(queue, False)
+    batch = queue.get()
+    hwrm_decode.set_filter([], [])
+    decode_pool = hwrm_decode.HwrmDecodePool()
+
+    def serial():
+        for hwrm_msg in unpack(batch):
+            hwrm_decode.print_hwrm_msg(hwrm_msg)
+
+    def pool():
+        decode_pool.add(batch)
+        decode_pool.print_done(wait=True)
+
+    outputs = []
+    for decode in [serial, pool]:
+        hwrm_decode.msg_cnt = 0
+        with redirect_stdout(io.StringIO()) as output:
+            decode()
+        outputs.append(output.getvalue())
+    if outputs[0] != outputs[1]:
+        raise AssertionError("Decode pool output does not match serial decode output.")
+    with redirect_stdout(io.StringIO()):
+        results = {
+            'serial': timeit(serial, number=number),
+            'pool': timeit(pool, number=number),
+        }
+        decode_pool.close()
+    report("hwrm_decode(254)", number, results)
+
+
+BENCHMARKS = {
+    'read_bytes': bench_read_bytes,
+    'device_locks': bench_device_locks,
+    'trace': bench_trace,
+    'hwrm_history': bench_hwrm_history,
+    'newest_index': bench_newest_index,
+    'msg_as_bytes': bench_msg_as_bytes,
+    'hwrm_decode': bench_hwrm_decode,
+}
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Run nitro micro-benchmarks.")
+    parser.add_argument('-n', '--number', type=int, default=5, help="Number of calls per variant. Defaults to 5.")
+    parser.add_argument('benchmark', nargs='*', help=f"Benchmarks to run: {', '.join(BENCHMARKS)}. By default, all "
+                                                     "benchmarks are run.")
+    args = parser.parse_args(args)
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark '{name}'.")
+    for name in args.benchmark or BENCHMARKS:
+        BENCHMARKS[name](args.number)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
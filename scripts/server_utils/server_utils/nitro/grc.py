@@ -1,6 +1,7 @@
 import logging
 import re
 import mmap
+import weakref
 from typing import List
 from ctypes import sizeof
 from server_utils.nitro.pci_bar0 import NitroPFBar0Struct
@@ -9,9 +10,40 @@ from threading import Lock
 
 log = logging.getLogger(__name__)
 
-# Create a lock for GRC register access.  Multiple threads may access the same window on the PCI BAR. This lock will
-# synchronize access to the window.
-grc_lock = Lock()
+
+class GRCWindowAllocator:
+    """
+    Hand out GRC windows of the PCI BAR so concurrent readers, such as the trace and the HWRM history readers, each
+    get their own window and do not have to wait on each other.
+
+    Each PCI device has its own allocator, see get_window_allocator(). Each window is owned by a single
+    GRCRegisterAccess and has its own lock, which synchronizes threads sharing that GRCRegisterAccess.
+    """
+    # Windows handed out, in order of preference, starting with window 14, the one these tools always used. The tools
+    # may run with bnxt_en loaded, and bnxt_en programs some of the low windows itself, for example for PTP, so only the
+    # high windows are handed out.
+    WINDOWS = tuple(range(14, 6, -1))
+
+    def __init__(self, pci_bdf: str, num_windows: int = 15):
+        self.pci_bdf = pci_bdf
+        self._lock = Lock()
+        self._free = list(self.WINDOWS)
+        self.locks = [Lock() for _ in range(num_windows)]
+
+    def alloc(self) -> int:
+        """Return a free window. Raise IndexError if all windows are in use."""
+        with self._lock:
+            if not self._free:
+                raise IndexError("Cannot create GRCRegisterAccess.  Out of windows.")
+            return self._free.pop(0)
+
+    def free(self, window: int):
+        """Return a window to the free list."""
+        with self._lock:
+            if window in self.WINDOWS and window not in self._free:
+                self._free.append(window)
+                self._free.sort(key=self.WINDOWS.index)
+
 
 def validate_bdf(pci_bdf):
     """Given a PCI BDF, return the linux path formatted BDF"""
@@ -29,31 +61,75 @@ def validate_bdf(pci_bdf):
     return f"{domain:04x}:{bus:02x}:{device:02x}.{function:01x}".lower()
 
 
-class GRCRegisterAccess:
-    WINDOW = 14
-    SEM_NAME = "SERVER_UTILS_SEM"
-    SEM_TIMEOUT = 10
+# GRC window allocators, and therefore window locks, keyed by the normalized PCI BDF. GRC access to different devices
+# never waits on each other.
+_window_allocators = dict()
+_window_allocators_lock = Lock()
 
-    def __init__(self, pci_bdf):
-        self.pci_bdf = pci_bdf
-        pci_bdf = validate_bdf(pci_bdf)
-        bar_file = open('/sys/bus/pci/devices/' + pci_bdf + '/resource0', 'r+b')
+
+def get_window_allocator(pci_bdf: str) -> GRCWindowAllocator:
+    """Return the GRC window allocator for the PCI device, creating it on first use."""
+    pci_bdf = validate_bdf(pci_bdf)
+    with _window_allocators_lock:
+        if pci_bdf not in _window_allocators:
+            _window_allocators[pci_bdf] = GRCWindowAllocator(pci_bdf)
+        return _window_allocators[pci_bdf]
+
+
+class SysfsBar0:
+    """PCI BAR0 of a real device, mapped through /sys/bus/pci/devices."""
+
+    def __init__(self, pci_bdf: str):
+        self.pci_bdf = validate_bdf(pci_bdf)
+
+    def map(self) -> mmap.mmap:
+        """Return the memory mapped BAR."""
+        bar_file = open('/sys/bus/pci/devices/' + self.pci_bdf + '/resource0', 'r+b')
         try:
-            bar_map = mmap.mmap(bar_file.fileno(), 0, )#flags=mmap.MAP_PRIVATE)
+            return mmap.mmap(bar_file.fileno(), 0, )#flags=mmap.MAP_PRIVATE)
         except OSError as err:
             log.critical("Unable to map the PCI bar registers. Try using option --driver-unload. This will unload the"
                          " driver and then attempt to map the PCI bar.  You can then reload the driver.")
             raise err
-        self.bar = NitroPFBar0Struct.from_buffer(bar_map)
-        try:
-            self.window = self.WINDOW
-        except IndexError:
-            raise IndexError("Cannot create GRCRegisterAccess.  Out of windows.")
+
+    def select_page(self, window: int):
+        """Called after a window base register is written. The device remaps the window, so nothing to do."""
+        pass
+
+
+class GRCRegisterAccess:
+    SEM_NAME = "SERVER_UTILS_SEM"
+    SEM_TIMEOUT = 10
+
+    def __init__(self, pci_bdf, backend=None):
+        """
+        :param pci_bdf: PCI BDF of the device
+        :param backend: provides the mapped BAR0. By default, the BAR of the real device is mapped through sysfs. See
+                        SimulatedBar0 in server_utils.nitro.simulated_bar0 for a backend that needs no hardware.
+        """
+        self.pci_bdf = pci_bdf
+        if backend is None:
+            backend = SysfsBar0(pci_bdf)
+        self.backend = backend
+        self.bar = NitroPFBar0Struct.from_buffer(backend.map())
+        # The window is released when this object is closed or garbage collected.
+        window_allocator = get_window_allocator(pci_bdf)
+        self.window = window_allocator.alloc()
+        self._finalizer = weakref.finalize(self, window_allocator.free, self.window)
+        self.lock = window_allocator.locks[self.window]
         self.window_size = int(sizeof(self.bar.window[self.window]))
         self.window_offset_mask = self.window_size - 1
         self.window_base_mask = int((1 << 32) - self.window_size)
+        # Base currently programmed in each window. None means unknown, so the next access will program it.
+        self._window_base = [None] * len(self.bar.base)
+        self.base_writes_issued = 0
+        self.base_writes_avoided = 0
         #self.sem = Semaphore(self.SEM_NAME, flags=O_CREAT, initial_value=1)
 
+    def close(self):
+        """Release the GRC window back to the allocator."""
+        self._finalizer()
+
     #def _sem_wait(self):
     #    try:
     #        self.sem.acquire(timeout=self.SEM_TIMEOUT)
@@ -64,31 +140,90 @@ class GRCRegisterAccess:
     #    self.sem.release()
 
     def set_window_base(self, window: int, base: int) -> int:
-        self.bar.base[window] = int(base & self.window_base_mask)
+        """
+        Select the 4KB page containing base in the window and return the offset of base within the window.
+
+        The base register is only written when the page differs from the one last programmed in the window.
+        """
+        window_base = int(base & self.window_base_mask)
+        if self._window_base[window] == window_base:
+            self.base_writes_avoided += 1
+        else:
+            self.bar.base[window] = window_base
+            self.backend.select_page(window)
+            self._window_base[window] = window_base
+            self.base_writes_issued += 1
         return int(base & self.window_offset_mask)
 
+    def invalidate_window_base(self, window: int = None):
+        """
+        Forget the cached window base so the next access reprograms it. Use this if something outside of this object,
+        such as bnxtmt, may have written the base register.
+
+        :param window: window to invalidate. By default, all windows are invalidated.
+        """
+        if window is None:
+            self._window_base = [None] * len(self._window_base)
+        else:
+            self._window_base[window] = None
+
+    @property
+    def base_write_stats(self) -> dict:
+        """Return the number of window base writes issued and avoided by caching."""
+        return dict(issued=self.base_writes_issued, avoided=self.base_writes_avoided)
+
     def read_words(self, addr: int, length: int = 1) -> List[int]:
         """Read 4-byte word from GRC register space."""
         if addr & 0x3:
             raise ValueError(f"Address 0x{addr:08x} must be on a 4-byte boundary")
         words = []
-        grc_lock.acquire()
+        self.lock.acquire()
         #self._sem_wait()
         for addr in range(addr, addr + (length * 4), 4):
             index = int(self.set_window_base(self.window, addr) / 4)
             words.append(self.bar.window[self.window][index])
         #self._sem_post()
-        grc_lock.release()
+        self.lock.release()
         return words
 
     def read_word(self, addr: int) -> int:
         return self.read_words(addr, 1)[0]
 
-    def read_bytes(self, addr: int, num_bytes: int) -> bytearray:
+    def read_bytes(self, addr: int, num_bytes: int, bulk: bool = True) -> bytearray:
+        """
+        Read bytes from GRC register space.
+
+        By default, each window-sized run is copied with a single slice of the mapped BAR window. Only whole 4-byte
+        words are read from the window, so an unaligned head or tail is read as part of its enclosing word and trimmed
+        afterwards.
+
+        :param addr: GRC byte address
+        :param num_bytes: number of bytes to read
+        :param bulk: if False, use the original byte-at-a-time path
+        :return: bytes read
+        """
+        if not bulk:
+            return self._read_bytes_by_byte(addr, num_bytes)
+        data = bytearray()
+        end_addr = int(addr + num_bytes)
+        self.lock.acquire()
+        while addr < end_addr:
+            offset = self.set_window_base(self.window, addr)
+            run = min(end_addr - addr, self.window_size - offset)
+            first_index = offset >> 2
+            last_index = (offset + run + 3) >> 2
+            words = memoryview(self.bar.window[self.window])[first_index:last_index].tobytes()
+            head = offset & 0x3
+            data += words[head:head + run]
+            addr += run
+        self.lock.release()
+        return data
+
+    def _read_bytes_by_byte(self, addr: int, num_bytes: int) -> bytearray:
         bytes = bytearray()
         end_addr = int(addr + num_bytes - 1)
         #self._sem_wait()
-        grc_lock.acquire()
+        self.lock.acquire()
         offset = int(self.set_window_base(self.window, addr))
         index = int(offset / 4)
         word = self.bar.window[self.window][index]
@@ -103,13 +238,13 @@ class GRCRegisterAccess:
                 index = int(offset / 4)
                 word = self.bar.window[self.window][index]
         #self._sem_post()
-        grc_lock.release()
+        self.lock.release()
         return bytes
 
     def write_bytes(self, addr: int, data: bytes):
         data = bytearray(data)
         end_addr = int(addr + len(data) - 1)
-        grc_lock.acquire()
+        self.lock.acquire()
         offset = int(self.set_window_base(self.window, addr))
         index = int(offset / 4)
         word = self.bar.window[self.window][index]
@@ -128,4 +263,4 @@ class GRCRegisterAccess:
             offset += 1
             if offset >= self.window_size:
                 offset = self.set_window_base(self.window, addr)
-        grc_lock.release()
+        self.lock.release()
@@ -0,0 +1,61 @@
+"""
+Binary capture file for HWRM history batches.
+
+Capturing stores each batch exactly as it was received from HwrmHistory.get_history(), so it costs no more than a
+write. The file is append-only: a magic string, then one frame per batch made of the host time it was received, the
+batch length and the batch of packed records. See server_utils.nitro.hwrm_msg_compact for the record layout.
+"""
+import logging
+import time
+from struct import Struct
+from typing import Iterator, List, Tuple, Union
+
+from server_utils.nitro.hwrm_msg_compact import HwrmMsgCompact, unpack
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"HWRMCAP1"
+# host time in seconds since the epoch, batch length in bytes
+FRAME = Struct('<dI')
+
+
+class HwrmCaptureWriter:
+    def __init__(self, path: str):
+        """Open the capture file for appending. A new file is started with the magic string."""
+        self.path = path
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def write(self, batch: bytes, host_time: float = None):
+        """Append a batch of packed records, stamped with the host time it was received."""
+        if host_time is None:
+            host_time = time.time()
+        self._file.write(FRAME.pack(host_time, len(batch)))
+        self._file.write(batch)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(path: str, raw: bool = False) -> Iterator[Tuple[float, Union[List[HwrmMsgCompact], bytes]]]:
+    """Yield the host time and decoded messages of each batch in the capture file. raw=True yields the batch bytes."""
+    with open(path, 'rb') as capture_file:
+        if capture_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an HWRM capture file.")
+        while True:
+            frame = capture_file.read(FRAME.size)
+            if not frame:
+                return
+            if len(frame) < FRAME.size:
+                log.warning(f"Capture file {path} ends with a truncated frame.")
+                return
+            host_time, length = FRAME.unpack(frame)
+            batch = capture_file.read(length)
+            if len(batch) < length:
+                log.warning(f"Capture file {path} ends with a truncated frame.")
+                return
+            yield host_time, batch if raw else unpack(batch)
@@ -1,9 +1,10 @@
 import logging
 from ctypes import sizeof, Structure, c_uint8, c_uint32, c_uint16
+from server_utils.helpers import AdaptivePoller
 from server_utils.nitro.grc import GRCRegisterAccess
 from server_utils.nitro.shmem import CfwShmemStruct
 from server_utils.nitro.address import firmware_to_host_addr, PRIMATE_SHMEM_OFFSET_LOCATION
-from server_utils.nitro.hwrm_msg_compact import compact
+from server_utils.nitro.hwrm_msg_compact import pack, pack_dropped, format_time_stamp
 from time import sleep
 
 log = logging.getLogger(__name__)
@@ -72,26 +73,15 @@ class HwrmHistEntryStruct(Structure):
 
         timestamp has a resolution of 100msec
         """
-        tmp = self.time_stamp
-        week = int(tmp / (7 * 24 * 60 * 600))
-        tmp %= (7 * 24 * 60 * 600)
-        day = int(tmp / (24 * 60 * 600))
-        tmp %= (24 * 60 * 600);
-        hour = int(tmp / (60 * 600))
-        tmp %= (60 * 600);
-        min = int(tmp / 600)
-        tmp %= 600;
-        return f"{week}W{day}d{hour:02d}:{min:02d}:{tmp/10.0:04.1f}"
+        return format_time_stamp(self.time_stamp)
 
     @property
     def msg_as_bytes(self):
-        bytes = bytearray()
-        for i in range(self.REQ_SIZE):
-            word_addr = int(i / 4)
-            word = self.msg[word_addr]
-            byte = int(i % 4)
-            bytes.append(int((word >> (byte * 8)) & 0xff))
-        return bytes
+        """
+        Return the message as bytes, copied straight out of the entry. The entry holds the bytes as firmware wrote
+        them, which is little-endian word order.
+        """
+        return bytearray(self.msg)
 
     def __str__(self):
         buffer = ""
@@ -115,12 +105,17 @@ class HwrmHistEntryStruct(Structure):
 
 
 class HwrmHistory:
-    def __init__(self, pci_bdf, filter_mask=0xf000):
-        self.grc = GRCRegisterAccess(pci_bdf)
+    # Full ring reads to try for one during which current_index does not move
+    MAX_RING_READS = 3
+
+    def __init__(self, pci_bdf, filter_mask=0xf000, backend=None):
+        self.grc = GRCRegisterAccess(pci_bdf, backend)
         self._shmem_ptr = None
         self._shmem = None
         self.last_index = None
         self.filter_mask = filter_mask
+        self.poller = AdaptivePoller()
+        self.stats = dict(polls=0, entries=0, overruns=0, dropped=0)
         self.set_filter()
 
     def set_filter(self):
@@ -152,6 +147,8 @@ class HwrmHistory:
                     log.warning('Shared memory struct, CfwShmemStruct, signature is invalid. Expected '
                                 f'0x{shmem.SIGNATURE:08x}. Received 0x{shmem.signature:08x}.')
                     self._shmem_ptr = None
+                    # A reset or bnxtmt may have moved the window, so reprogram it on the next read
+                    self.grc.invalidate_window_base()
                 else:
                     self._shmem = shmem
                     break
@@ -164,7 +161,6 @@ class HwrmHistory:
     @property
     def hwrm_history_list(self):
         while True:
-            self.set_filter()
             bytes = self.grc.read_bytes(self.hwrm_history_offset, sizeof(HwrmHistListStruct))
             hwrm_hist_list = HwrmHistListStruct.from_buffer(bytes)
             log.debug(f"hwrm_hist_list signature = 0x{hwrm_hist_list.signature:08x}.")
@@ -173,52 +169,150 @@ class HwrmHistory:
                 log.warning("HWRM history list signature check failed. Resetting history.")
                 self._shmem = None
                 self.last_index = None
+                self.grc.invalidate_window_base()
                 sleep(.1)
             else:
                 break
+        if hwrm_hist_list.filter_mask != self.filter_mask:
+            # Firmware does not change the filter on its own, so only rewrite it after a reset.
+            self.set_filter()
+            hwrm_hist_list.filter_mask = self.filter_mask
         return hwrm_hist_list
 
     def get_newest_index(self, bytes, max_entries):
-        """Return the index for the newest entry"""
-        max_timestamp = -1
-        newest_index = -1
-        for i in range(max_entries):
-            hwrm_entry = HwrmHistEntryStruct.from_buffer(bytes, sizeof(HwrmHistEntryStruct) * i)
-            if hwrm_entry.time_stamp >= max_timestamp:
-                max_timestamp = hwrm_entry.time_stamp
-                newest_index = i
-        return newest_index
+        """
+        Return the index for the newest entry. If several entries share the newest time stamp, the last one wins.
+
+        The time stamps are pulled out of the raw entries with a single strided slice, without creating an object per
+        entry.
+        """
+        if not max_entries:
+            return -1
+        stride = int(sizeof(HwrmHistEntryStruct) / sizeof(c_uint32))
+        words = memoryview(bytes)[:sizeof(HwrmHistEntryStruct) * max_entries].cast('I')
+        time_stamps = words[HwrmHistEntryStruct.time_stamp.offset // sizeof(c_uint32)::stride].tolist()
+        time_stamps.reverse()
+        return max_entries - 1 - time_stamps.index(max(time_stamps))
+
+    def pack_entries(self, bytes, first_index, count, max_entries, bytes_index=0):
+        """
+        Return count entries starting at ring index first_index, wrapping at the end of the ring, as a packed batch.
+        See server_utils.nitro.hwrm_msg_compact.unpack().
+
+        :param bytes: raw entries, starting with the entry at ring index bytes_index
+        """
+        buffer = []
+        for i in range(count):
+            index = (first_index + i) % max_entries
+            offset = sizeof(HwrmHistEntryStruct) * ((index - bytes_index) % max_entries)
+            hwrm_entry = HwrmHistEntryStruct.from_buffer(bytes, offset)
+            buffer.append(pack(index, max_entries, hwrm_entry))
+        return b"".join(buffer)
+
+    def get_stats(self):
+        """
+        Return counters for this reader: polls of the history list, entries sent, ring overruns detected and the
+        minimum number of entries dropped by them.
+        """
+        return dict(self.stats)
+
+    def read_entries(self, ptr_addr, first_index, count, max_entries):
+        """Read count raw entries starting at ring index first_index, wrapping at the end of the ring."""
+        bytes = bytearray()
+        while count:
+            run = min(count, max_entries - first_index)
+            bytes += self.grc.read_bytes(ptr_addr + sizeof(HwrmHistEntryStruct) * first_index,
+                                         sizeof(HwrmHistEntryStruct) * run)
+            count -= run
+            first_index = 0
+        return bytes
+
+    def read_overrun(self, ptr_addr, newest_index, dropped, max_entries):
+        """
+        Count an overrun of at least dropped entries. Return the whole ring, and a batch of it preceded by a record
+        giving the number of dropped entries. Only the newest max_entries are still in the ring.
+        """
+        log.warning(f"HWRM history ring overrun. At least {dropped} entries were dropped.")
+        self.stats['overruns'] += 1
+        self.stats['dropped'] += dropped
+        bytes = self.read_entries(ptr_addr, 0, max_entries, max_entries)
+        return bytes, pack_dropped(dropped, max_entries) + self.pack_entries(bytes, newest_index + 1, max_entries,
+                                                                             max_entries)
+
+    def get_time_stamp(self, bytes, index, max_entries, bytes_index=0):
+        """Return the time stamp of the entry at ring index index. bytes starts with the entry at bytes_index."""
+        offset = sizeof(HwrmHistEntryStruct) * ((index - bytes_index) % max_entries)
+        return HwrmHistEntryStruct.from_buffer(bytes, offset).time_stamp
 
     def get_history(self, queue, follow):
+        """
+        Put the whole history ring on the queue. If follow is True, keep polling and put only new entries. Entries are
+        put as one packed batch per poll, see server_utils.nitro.hwrm_msg_compact.unpack().
+
+        The ring is read once to find the newest entry from the time stamps. It is read again, up to MAX_RING_READS
+        times, until current_index does not move during the read. After that, only the history list is polled, at an
+        interval set by self.poller. The entries between the last index and the newest index are read when
+        current_index moves. The last entry already sent is read again with them, and its time stamp alone is read when
+        current_index does not move. If its time stamp changed, firmware lapped the ring between polls. The whole ring
+        is then sent, preceded by a record giving the minimum number of dropped entries. See get_stats().
+        """
+        index_delta = 0
+        last_time_stamp = None
+        ring_reads = 0
         while True:
             hwrm_history_list = self.hwrm_history_list
             ptr_addr = firmware_to_host_addr(hwrm_history_list.ptr_addr)
             max_entries = hwrm_history_list.max_entries
-            bytes = self.grc.read_bytes(ptr_addr, sizeof(HwrmHistEntryStruct) * max_entries)
-            newest_index = self.get_newest_index(bytes, max_entries)
-            if newest_index < 0:
-                sleep(.1)
-                continue
-            elif self.last_index is None:
-                self.last_index = newest_index
+            self.stats['polls'] += 1
+            if self.last_index is None:
+                bytes = self.grc.read_bytes(ptr_addr, sizeof(HwrmHistEntryStruct) * max_entries)
+                current_index = self.hwrm_history_list.current_index
+                ring_reads += 1
+                if current_index != hwrm_history_list.current_index and ring_reads < self.MAX_RING_READS:
+                    # Firmware wrote entries while the ring was read, so current_index does not match the ring.
+                    self.poller.wait(False)
+                    continue
+                newest_index = self.get_newest_index(bytes, max_entries)
+                if newest_index < 0:
+                    sleep(.1)
+                    continue
+                if current_index != hwrm_history_list.current_index:
+                    log.debug(f"HWRM history current_index moved during {ring_reads} ring reads. Using the newest "
+                              "entry from the time stamps.")
+                # Remember where the newest entry is relative to current_index, so later polls can find it without
+                # reading the time stamps.
+                index_delta = (newest_index - current_index) % max_entries
+                bytes_index = 0
+                count = max_entries
+                buffer = self.pack_entries(bytes, newest_index + 1, max_entries, max_entries)
             elif not follow:
                 break
-            elif newest_index == self.last_index:
-                sleep(.1)
-                continue
-            buffer = []
-            if newest_index > self.last_index:
-                for i in range(self.last_index + 1, newest_index + 1):
-                    hwrm_entry = HwrmHistEntryStruct.from_buffer(bytes, sizeof(HwrmHistEntryStruct) * i)
-                    buffer.append(compact(i, max_entries, hwrm_entry))
             else:
-                # Circular buffer has rolled over
-                if self.last_index + 1 < max_entries:
-                    for i in range(self.last_index + 1, max_entries):
-                        hwrm_entry = HwrmHistEntryStruct.from_buffer(bytes, sizeof(HwrmHistEntryStruct) * i)
-                        buffer.append(compact(i, max_entries, hwrm_entry))
-                for i in range(0, newest_index + 1):
-                    hwrm_entry = HwrmHistEntryStruct.from_buffer(bytes, sizeof(HwrmHistEntryStruct) * i)
-                    buffer.append(compact(i, max_entries, hwrm_entry))
+                newest_index = (hwrm_history_list.current_index + index_delta) % max_entries
+                if newest_index == self.last_index:
+                    time_stamp = self.grc.read_word(ptr_addr + sizeof(HwrmHistEntryStruct) * self.last_index +
+                                                    HwrmHistEntryStruct.time_stamp.offset)
+                    if time_stamp == last_time_stamp:
+                        self.poller.wait(False)
+                        continue
+                    # The index did not move, but firmware wrote a whole number of rings since the last poll.
+                    bytes, buffer = self.read_overrun(ptr_addr, newest_index, max_entries, max_entries)
+                    bytes_index = 0
+                    count = max_entries
+                else:
+                    count = (newest_index - self.last_index) % max_entries
+                    bytes = self.read_entries(ptr_addr, self.last_index, count + 1, max_entries)
+                    bytes_index = self.last_index
+                    if self.get_time_stamp(bytes, bytes_index, max_entries, bytes_index) == last_time_stamp:
+                        buffer = self.pack_entries(bytes, self.last_index + 1, count, max_entries, bytes_index)
+                    else:
+                        # Firmware wrote at least a full ring plus count entries since the last poll.
+                        bytes, buffer = self.read_overrun(ptr_addr, newest_index, count, max_entries)
+                        bytes_index = 0
+                        count = max_entries
+            self.stats['entries'] += count
             queue.put(buffer)
-            self.last_index = newest_index
\ No newline at end of file
+            self.last_index = newest_index
+            last_time_stamp = self.get_time_stamp(bytes, newest_index, max_entries, bytes_index)
+            if follow:
+                self.poller.wait(True)
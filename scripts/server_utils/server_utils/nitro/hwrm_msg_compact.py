@@ -1,22 +1,74 @@
-"""Compact HWRM message that will be used to pass HWRM messages from the server back to the client via a queue."""
+"""
+Compact HWRM message that will be used to pass HWRM messages from the server back to the client via a queue.
+
+A batch of messages crosses RPyC as a single bytes object of fixed size records, see pack() and unpack(). The client
+decodes the batch locally, so no attribute of a message is ever fetched from the remote.
+"""
+from struct import Struct
+from typing import List
+
+# index, max_entries, channel, flags, time_stamp, 128 byte message
+RECORD = Struct('<HHHHI128s')
+FLAG_REQUEST = 0x1
+# The record is not a message. It reports that the reader dropped time_stamp entries because the ring was overrun.
+FLAG_DROPPED = 0x2
+
+
+def format_time_stamp(time_stamp: int) -> str:
+    """
+    Return time in the format of #W#d##:##:##.#  - W = Week, d = day ##:##:##.! = hour:min:sec.
+
+    timestamp has a resolution of 100msec
+    """
+    tmp = time_stamp
+    week = int(tmp / (7 * 24 * 60 * 600))
+    tmp %= (7 * 24 * 60 * 600)
+    day = int(tmp / (24 * 60 * 600))
+    tmp %= (24 * 60 * 600);
+    hour = int(tmp / (60 * 600))
+    tmp %= (60 * 600);
+    min = int(tmp / 600)
+    tmp %= 600;
+    return f"{week}W{day}d{hour:02d}:{min:02d}:{tmp/10.0:04.1f}"
 
 
 class HwrmMsgCompact:
-    def __init__(self):
-        self.index = 0
-        self.max_entries = 0
-        self.request = False
-        self.bytes = bytearray()
-        self.channel = 0
-        self.time = ""
-
-
-def compact(index, max_entries, hwrm_ctype):
-    hwrm_compact = HwrmMsgCompact()
-    hwrm_compact.max_entries = max_entries
-    hwrm_compact.index = index
-    hwrm_compact.time = hwrm_ctype.time
-    hwrm_compact.channel = hwrm_ctype.channel
-    hwrm_compact.request = hwrm_ctype.is_request
-    hwrm_compact.bytes = hwrm_ctype.msg_as_bytes
-    return hwrm_compact
+    __slots__ = ('index', 'max_entries', 'request', 'bytes', 'channel', 'time_stamp', 'dropped')
+
+    def __init__(self, index=0, max_entries=0, request=False, bytes=None, channel=0, time_stamp=0, dropped=0):
+        self.index = index
+        self.max_entries = max_entries
+        self.request = request
+        self.bytes = bytearray() if bytes is None else bytes
+        self.channel = channel
+        self.time_stamp = time_stamp
+        # If non-zero, this is not a message but a report of at least this many dropped messages
+        self.dropped = dropped
+
+    @property
+    def time(self):
+        return format_time_stamp(self.time_stamp)
+
+
+def pack(index, max_entries, hwrm_ctype) -> bytes:
+    """Return the HwrmHistEntryStruct as a single record. Concatenate records to build a batch."""
+    flags = FLAG_REQUEST if hwrm_ctype.is_request else 0
+    return RECORD.pack(index, max_entries, hwrm_ctype.channel, flags, hwrm_ctype.time_stamp,
+                       bytes(hwrm_ctype.msg_as_bytes))
+
+
+def pack_dropped(count, max_entries) -> bytes:
+    """Return a record reporting that at least count entries were dropped."""
+    return RECORD.pack(0, max_entries, 0, FLAG_DROPPED, count, b"")
+
+
+def unpack(batch: bytes) -> List[HwrmMsgCompact]:
+    """Decode a batch of records into messages. Dropped entry reports have a non-zero dropped attribute."""
+    hwrm_msgs = []
+    for index, max_entries, channel, flags, time_stamp, msg in RECORD.iter_unpack(batch):
+        if flags & FLAG_DROPPED:
+            hwrm_msgs.append(HwrmMsgCompact(max_entries=max_entries, dropped=time_stamp))
+            continue
+        hwrm_msgs.append(HwrmMsgCompact(index, max_entries, bool(flags & FLAG_REQUEST), bytearray(msg), channel,
+                                        time_stamp))
+    return hwrm_msgs
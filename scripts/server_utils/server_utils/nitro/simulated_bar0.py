@@ -0,0 +1,190 @@
+"""
+Simulated Nitro PF BAR0 for running and benchmarking the nitro readers without Thor hardware.
+
+The BAR is a regular file or an anonymous memory map laid out as NitroPFBar0Struct. The 4GB GRC space behind the
+windows is kept sparsely, one 4KB page at a time, and the windows are remapped when GRCRegisterAccess writes a window
+base register. seed() lays out CfwShmemStruct, the trace buffer and the HWRM history the way firmware does, and
+append_trace() and add_hwrm_entry() play the part of firmware adding to them.
+
+    bar = SimulatedBar0()
+    bar.seed()
+    bar.append_trace(b"0.1: hello\\n")
+    trace = Trace("ffff:00:00.0", backend=bar)
+"""
+import mmap
+import os
+from ctypes import sizeof, memmove
+from threading import RLock
+
+from server_utils.nitro.address import firmware_to_host_addr, PRIMATE_SHMEM_OFFSET_LOCATION, PRIMATE_VIEW_SRAM_BASE
+from server_utils.nitro.hwrm_history import HwrmHistListStruct, HwrmHistEntryStruct
+from server_utils.nitro.pci_bar0 import NitroPFBar0Struct
+from server_utils.nitro.shmem import CfwShmemStruct
+from server_utils.nitro.trace import TraceHdrStruct, TraceBufStruct, DEBUG_TRACE_SIZE
+
+
+class SimulatedBar0:
+    # Firmware addresses of the structures laid out by seed()
+    SHMEM_ADDR = PRIMATE_VIEW_SRAM_BASE + 0x1000
+    TRACE_ADDR = PRIMATE_VIEW_SRAM_BASE + 0x10000
+    HWRM_HISTORY_ADDR = PRIMATE_VIEW_SRAM_BASE + 0x20000
+    HWRM_ENTRIES_ADDR = PRIMATE_VIEW_SRAM_BASE + 0x20100
+
+    def __init__(self, path: str = None):
+        """
+        :param path: file to map as the BAR. It is extended to the size of NitroPFBar0Struct if needed. By default,
+                     anonymous memory is used.
+        """
+        size = sizeof(NitroPFBar0Struct)
+        if path is None:
+            self._map = mmap.mmap(-1, size)
+        else:
+            with open(path, 'ab') as bar_file:
+                if os.fstat(bar_file.fileno()).st_size < size:
+                    bar_file.truncate(size)
+            with open(path, 'r+b') as bar_file:
+                self._map = mmap.mmap(bar_file.fileno(), size)
+        self.bar = NitroPFBar0Struct.from_buffer(self._map)
+        self.page_size = sizeof(self.bar.window[0])
+        self.pages = dict()
+        # Page currently copied into each window
+        self._window_page = [None] * len(self.bar.window)
+        self._lock = RLock()
+        self._time_stamp = 0
+
+    def map(self) -> mmap.mmap:
+        """Return the memory mapped BAR."""
+        return self._map
+
+    def _page(self, base: int) -> bytearray:
+        if base not in self.pages:
+            self.pages[base] = bytearray(self.page_size)
+        return self.pages[base]
+
+    def _window_offset(self, window: int) -> int:
+        return NitroPFBar0Struct.window.offset + window * self.page_size
+
+    def _flush(self, window: int):
+        """Copy the window back to the GRC page it maps, so writes through the window are kept."""
+        base = self._window_page[window]
+        if base is not None:
+            offset = self._window_offset(window)
+            self._page(base)[:] = self._map[offset:offset + self.page_size]
+
+    def _load(self, window: int, base: int):
+        offset = self._window_offset(window)
+        self._map[offset:offset + self.page_size] = self._page(base)
+        self._window_page[window] = base
+
+    def select_page(self, window: int):
+        """
+        Called after a window base register is written. Remap the window to the page selected by the base.
+
+        Two windows that map the same page at the same time are not kept coherent with each other.
+        """
+        with self._lock:
+            self._flush(window)
+            base = self.bar.base[window] & ~(self.page_size - 1)
+            for other_window, other_base in enumerate(self._window_page):
+                if other_base == base and other_window != window:
+                    self._flush(other_window)
+            self._load(window, base)
+
+    def _access(self, addr: int, num_bytes: int):
+        """Yield (page base, page offset, data offset, length) for each page touched by an access."""
+        data_offset = 0
+        while data_offset < num_bytes:
+            base = addr & ~(self.page_size - 1)
+            offset = addr & (self.page_size - 1)
+            length = min(num_bytes - data_offset, self.page_size - offset)
+            yield base, offset, data_offset, length
+            addr += length
+            data_offset += length
+
+    def read(self, addr: int, num_bytes: int) -> bytearray:
+        """Read the GRC space as firmware sees it, including writes made through the windows."""
+        data = bytearray(num_bytes)
+        with self._lock:
+            for base, offset, data_offset, length in self._access(addr, num_bytes):
+                for window, window_base in enumerate(self._window_page):
+                    if window_base == base:
+                        self._flush(window)
+                data[data_offset:data_offset + length] = self._page(base)[offset:offset + length]
+        return data
+
+    def write(self, addr: int, data: bytes):
+        """Write the GRC space as firmware would. Windows mapping the written pages see the new data."""
+        with self._lock:
+            for base, offset, data_offset, length in self._access(addr, len(data)):
+                windows = [window for window, window_base in enumerate(self._window_page) if window_base == base]
+                for window in windows:
+                    self._flush(window)
+                self._page(base)[offset:offset + length] = data[data_offset:data_offset + length]
+                for window in windows:
+                    self._load(window, base)
+
+    def seed(self, max_entries: int = 255, filter_mask: int = 0xf000):
+        """Lay out the shared memory, trace buffer and HWRM history the way firmware does."""
+        self.write(firmware_to_host_addr(PRIMATE_SHMEM_OFFSET_LOCATION), self.SHMEM_ADDR.to_bytes(4, 'little'))
+        shmem = CfwShmemStruct(signature=CfwShmemStruct.SIGNATURE,
+                               size=sizeof(CfwShmemStruct),
+                               trace_buf_offset=self.TRACE_ADDR,
+                               trace_buf_size=DEBUG_TRACE_SIZE,
+                               hwrm_history_offset=self.HWRM_HISTORY_ADDR)
+        self.write(firmware_to_host_addr(self.SHMEM_ADDR), bytes(shmem))
+        trace_hdr = TraceHdrStruct(signature=TraceHdrStruct.SIGNATURE,
+                                   trace_idx=self.TRACE_ADDR + sizeof(TraceHdrStruct))
+        self.write(firmware_to_host_addr(self.TRACE_ADDR), bytes(trace_hdr))
+        self.write(firmware_to_host_addr(self.TRACE_ADDR) + sizeof(TraceHdrStruct), bytes(sizeof(TraceBufStruct)))
+        hwrm_hist_list = HwrmHistListStruct(signature=HwrmHistListStruct.SIGNATURE,
+                                            max_entries=max_entries,
+                                            current_index=max_entries - 1,
+                                            filter_mask=filter_mask,
+                                            ptr_addr=self.HWRM_ENTRIES_ADDR)
+        self.write(firmware_to_host_addr(self.HWRM_HISTORY_ADDR), bytes(hwrm_hist_list))
+        self.write(firmware_to_host_addr(self.HWRM_ENTRIES_ADDR), bytes(sizeof(HwrmHistEntryStruct) * max_entries))
+
+    def append_trace(self, text: bytes):
+        """Append text to the trace ring and advance the trace index, wrapping like firmware does."""
+        with self._lock:
+            hdr_addr = firmware_to_host_addr(self.TRACE_ADDR)
+            trace_hdr = TraceHdrStruct.from_buffer(self.read(hdr_addr, sizeof(TraceHdrStruct)))
+            buf_addr = hdr_addr + sizeof(TraceHdrStruct)
+            buf_size = sizeof(TraceBufStruct)
+            offset = firmware_to_host_addr(trace_hdr.trace_idx) - buf_addr
+            while text:
+                chunk = text[:buf_size - offset]
+                self.write(buf_addr + offset, chunk)
+                text = text[len(chunk):]
+                offset = (offset + len(chunk)) % buf_size
+            # The address translation is its own inverse
+            trace_hdr.trace_idx = firmware_to_host_addr(buf_addr + offset)
+            self.write(hdr_addr, bytes(trace_hdr))
+
+    def add_hwrm_entry(self, msg: bytes, channel: int = 0, request: bool = True, time_stamp: int = None):
+        """
+        Add an HWRM message to the history ring and advance the current index.
+
+        :param msg: message bytes. Only the first 128 bytes are kept, like firmware does.
+        :param channel: HWRM channel
+        :param request: True for a request, False for a response
+        :param time_stamp: entry time stamp in 100ms units. By default, one more than the previous entry.
+        """
+        with self._lock:
+            list_addr = firmware_to_host_addr(self.HWRM_HISTORY_ADDR)
+            hwrm_hist_list = HwrmHistListStruct.from_buffer(self.read(list_addr, sizeof(HwrmHistListStruct)))
+            index = (hwrm_hist_list.current_index + 1) % hwrm_hist_list.max_entries
+            if time_stamp is None:
+                time_stamp = self._time_stamp + 1
+            self._time_stamp = time_stamp
+            msg = bytes(msg[:HwrmHistEntryStruct.REQ_SIZE])
+            entry = HwrmHistEntryStruct(time_stamp=time_stamp)
+            entry.chnl_and_len = ((channel << HwrmHistEntryStruct.CHNL_SFT) & HwrmHistEntryStruct.CHNL_MASK) | \
+                                 (len(msg) & HwrmHistEntryStruct.LEN_MASK)
+            if not request:
+                entry.resp_code = HwrmHistEntryStruct.RESP_SIGNATURE
+            memmove(entry.msg, msg, len(msg))
+            entry_addr = firmware_to_host_addr(hwrm_hist_list.ptr_addr) + index * sizeof(HwrmHistEntryStruct)
+            self.write(entry_addr, bytes(entry))
+            hwrm_hist_list.current_index = index
+            self.write(list_addr, bytes(hwrm_hist_list))
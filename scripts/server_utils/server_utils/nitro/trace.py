@@ -1,9 +1,9 @@
 import logging
 from ctypes import sizeof, Structure, c_uint8, c_uint32, POINTER, cast
+from server_utils.helpers import AdaptivePoller
 from server_utils.nitro.grc import GRCRegisterAccess
 from server_utils.nitro.shmem import CfwShmemStruct
 from server_utils.nitro.address import firmware_to_host_addr, PRIMATE_SHMEM_OFFSET_LOCATION
-from time import sleep
 
 log = logging.getLogger(__name__)
 
@@ -26,11 +26,17 @@ class TraceBufStruct(Structure):
 
 
 class Trace:
-    def __init__(self, pci_bdf):
-        self.grc = GRCRegisterAccess(pci_bdf)
+    # Number of bytes before the trace index that are read again on each poll to detect ring overruns
+    GUARD_SIZE = 32
+
+    def __init__(self, pci_bdf, backend=None):
+        self.grc = GRCRegisterAccess(pci_bdf, backend)
         self._shmem_ptr = None
         self._shmem = None
         self.last_trace_idx = None
+        self._guard = b""
+        self.poller = AdaptivePoller()
+        self.stats = dict(polls=0, bytes=0, overruns=0, dropped=0)
 
     @property
     def shmem_ptr_ptr(self):
@@ -76,6 +82,8 @@ class Trace:
             trace_hdr = TraceHdrStruct.from_buffer(bytes)
             if trace_hdr.signature != trace_hdr.SIGNATURE:
                 log.warning("Trace header signature check failed.")
+                # A reset or bnxtmt may have moved the window, so reprogram it on the next read
+                self.grc.invalidate_window_base()
             else:
                 break
             log.debug(f"trace_hdr signature = 0x{trace_hdr.signature:08x}.")
@@ -91,35 +99,81 @@ class Trace:
         bytes = self.grc.read_bytes(addr, size)
         return bytes
 
-    def trace(self, queue, follow):
+    def read_trace(self, last_trace_offset, trace_offset):
+        """Return the trace bytes written between the two offsets, joining both ends of the ring if it rolled over."""
+        if trace_offset > last_trace_offset:
+            return self.get_trace_buf(last_trace_offset, trace_offset - last_trace_offset)
+        # Circular buffer has rolled over
+        trace_buf = self.get_trace_buf(last_trace_offset, self.trace_buf_size - last_trace_offset)
+        if trace_offset:
+            trace_buf += self.get_trace_buf(0, trace_offset)
+        return trace_buf
+
+    def read_overrun(self, trace_offset, lost):
+        """Count an overrun of at least lost bytes and return the whole ring, preceded by a notice."""
+        log.warning(f"Trace ring overrun. At least {lost} bytes were lost.")
+        self.stats['overruns'] += 1
+        self.stats['dropped'] += lost
+        notice = f"\n*** Trace ring overrun. At least {lost} bytes were lost. ***\n".encode()
+        return notice + self.read_trace(trace_offset, trace_offset)
+
+    def get_stats(self):
+        """
+        Return counters for this reader: polls of the trace index, bytes sent, ring overruns detected and the minimum
+        number of bytes lost to them.
+        """
+        return dict(self.stats)
+
+    def trace(self, queue, follow, raw=False):
+        """
+        Put the trace buffer on the queue. If follow is True, keep polling, at an interval set by self.poller, and put
+        only new trace output.
+
+        The trace index only tells how far firmware is into the ring, not how many times it went around. To detect an
+        overrun, the last GUARD_SIZE bytes already sent are read again with the new output. If firmware changed them,
+        it lapped the ring since the last poll. The whole ring is then sent, preceded by a line giving the minimum
+        number of bytes lost. The guard is also checked when the index has not moved, in case firmware wrote a whole
+        number of rings. See get_stats().
+
+        :param queue: queue to put the trace output on
+        :param follow: keep polling for new output
+        :param raw: put the trace as bytes instead of str, so it can be forwarded without decoding
+        """
         while True:
             trace_idx = firmware_to_host_addr(self.trace_hdr.trace_idx)
             trace_offset = trace_idx - self.trace_buf_offset
+            self.stats['polls'] += 1
             if self.last_trace_idx is None:
-                last_trace_offset = trace_offset
+                trace_buf = self.read_trace(trace_offset, trace_offset)
+                guard_size = 0
             elif trace_idx != self.last_trace_idx:
                 last_trace_offset = self.last_trace_idx - self.trace_buf_offset
+                new_size = (trace_offset - last_trace_offset) % self.trace_buf_size
+                # Once firmware has written nearly a full ring, it has overwritten the guard without lapping.
+                guard_size = min(self.GUARD_SIZE, len(self._guard), self.trace_buf_size - new_size)
+                trace_buf = self.read_trace((last_trace_offset - guard_size) % self.trace_buf_size, trace_offset)
+                if trace_buf[:guard_size] != self._guard[len(self._guard) - guard_size:]:
+                    trace_buf = self.read_overrun(trace_offset, new_size)
+                    guard_size = 0
+            elif self.read_trace((trace_offset - len(self._guard)) % self.trace_buf_size, trace_offset) != self._guard:
+                # The index did not move, but firmware wrote a whole number of rings since the last poll.
+                trace_buf = self.read_overrun(trace_offset, self.trace_buf_size)
+                guard_size = 0
             else:
-                sleep(.1)
+                self.poller.wait(False)
                 continue
-            buffer = ""
-            if trace_offset > last_trace_offset:
-                trace_buf = self.get_trace_buf(last_trace_offset, trace_offset - last_trace_offset)
-                for byte in trace_buf:
-                    buffer += chr(byte)
-            else:
-                # Circular buffer has rolled over
-                trace_buf = self.get_trace_buf(last_trace_offset, self.trace_buf_size - last_trace_offset)
-                for byte in trace_buf:
-                    buffer += chr(byte)
-                trace_buf = self.get_trace_buf(0, trace_offset)
-                for byte in trace_buf:
-                    buffer += chr(byte)
+            self._guard = bytes(trace_buf[-self.GUARD_SIZE:])
+            trace_buf = bytes(trace_buf[guard_size:])
+            self.stats['bytes'] += len(trace_buf)
+            if not raw:
+                # latin-1 maps each byte to the character with the same code
+                trace_buf = trace_buf.decode('latin-1')
             try:
-                queue.put(buffer)
+                queue.put(trace_buf)
             except EOFError:
                 # Not sure why, but sometimes get an EOFError exception. Doesn't seem to cause any harm, so ignoring.
                 pass
             if not follow:
                 break
-            self.last_trace_idx = trace_idx
\ No newline at end of file
+            self.last_trace_idx = trace_idx
+            self.poller.wait(True)
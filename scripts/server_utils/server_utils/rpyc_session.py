@@ -166,6 +166,13 @@ class RPyCSession:
                 log.debug(f"RPyC connection to {self.address} failed ping test. Connection not active.")
         return False
 
+    @connected_only
+    def serve(self, timeout: float = 1) -> bool:
+        """Serve requests from the remote, such as a remote thread putting on a local queue. Block for up to timeout
+        seconds waiting for one. Return True if a request was served.
+        """
+        return self.conn.serve(timeout)
+
     @connected_only
     def upload(self, srcpath: str, dstpath: str) -> None:
         rpyc.utils.classic.upload(self.conn, srcpath, dstpath)
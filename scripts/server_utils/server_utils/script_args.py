@@ -6,6 +6,7 @@ from confuse.exceptions import NotFoundError
 
 from server_utils.config import config
 from server_utils.helpers import list_to_string
+from server_utils.nitro.grc import validate_bdf
 from server_utils.sit import get_sit_version
 
 
@@ -24,6 +25,12 @@ def add_autoneg_arg(parser):
     parser.add_argument('-a', '--autoneg', action="store_true", help="Enable auto-negotiation", default=False)
 
 
+def add_capture_arg(parser):
+    parser.add_argument('-c', '--capture', type=str, help="Append the raw HWRM history to this capture file instead of "
+                                                          "decoding it. Use hwrm_decode to decode the capture later.",
+                        default="")
+
+
 def add_driver_unload_arg(parser):
     parser.add_argument('-u', '--driver-unload', action="store_true", help="Unload the driver before attempting to map"
                                                                            " PCI BAR.", default=False)
@@ -54,6 +61,12 @@ def add_interface_arg(parser):
                                                             "config will be used.", default=None)
 
 
+def add_jobs_arg(parser):
+    parser.add_argument('-j', '--jobs', type=int, help="Decode HWRM messages in this many worker processes. By "
+                                                       "default, messages are decoded by the main process.",
+                        default=0)
+
+
 def add_live_arg(parser):
     parser.add_argument('-l', '--live', action="store_true", help="Use bnxtnvm -live option to install package instead."
                                                                   " bnxtmt nvm pkginstall is used by default.")
@@ -62,6 +75,13 @@ def add_package_arg(parser):
     parser.add_argument('-p', '--package', type=str, help="Package file name", default=None)
 
 
+def add_pci_bdf_arg(parser):
+    parser.add_argument('-b', '--pci-bdf', type=str, action='append', help="PCI BDF of a NIC to capture from. This "
+                                                                           "option may be used multiple times. By "
+                                                                           "default, all NICs of the server in config "
+                                                                           "are used.", default=[])
+
+
 def add_rpyc_restart_arg(parser):
     parser.add_argument('--rpyc-restart', action="store_true", help="Force a re-sync and restart of the RPyC server. "
                                                                     "This will kill The RPyC server, rsync "
@@ -89,6 +109,17 @@ def add_speed_arg(parser):
                                                                " speeds.", default=[])
 
 
+def add_stats_arg(parser):
+    parser.add_argument('--stats', type=float, help="Instead of printing each HWRM message, pair requests with their "
+                                                    "responses and print a summary of counts, error rates and "
+                                                    "latencies per message type every STATS seconds.", default=0)
+
+
+def add_store_arg(parser):
+    parser.add_argument('--store', type=str, help="Add the HWRM messages to this indexed store instead of printing "
+                                                  "them. Use hwrm_query to search the store.", default="")
+
+
 def add_tail_arg(parser):
     parser.add_argument('-f', action="store_true", help="Follow the output like 'tail -f'", dest="tail", default=False)
 
@@ -118,6 +149,12 @@ def validate_filter_mask(args):
     if args.filter_mask < 0 or args.filter_mask > 65535:
         arg_error(f"Invalid --filter-mask option. Value must be valid hex value between 0x0000 and 0xFFFF.")
 
+
+def validate_jobs(args):
+    if args.jobs < 0:
+        arg_error(f"Invalid --jobs option. Value must not be negative.")
+
+
 def validate_local(args):
     if not os.path.isdir(args.local):
         arg_error(f"Invalid --local option. {args.local} is not a directory.")
@@ -138,6 +175,14 @@ def validate_server(args):
             arg_error(f"Server '{server}' does not exist in configuration.")
 
 
+def validate_pci_bdf(args):
+    for pci_bdf in args.pci_bdf:
+        try:
+            validate_bdf(pci_bdf)
+        except ValueError as e:
+            arg_error(f"Invalid --pci-bdf option. {e}")
+
+
 def validate_sit(args):
     sit_version = args.sit.split(".")
     if len(sit_version) < 1 or len(sit_version) > 4:
@@ -179,6 +224,11 @@ def validate_speed(args):
     args.speed = translated_speeds
 
 
+def validate_stats(args):
+    if args.stats < 0:
+        arg_error(f"Invalid --stats option. Value must not be negative.")
+
+
 def validate_verbose(args):
     if args.verbose is None:
         verbosity_map = dict(
@@ -1,6 +1,9 @@
 import logging
 import re
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
+from select import select
+from typing import Callable, Iterator, List, Tuple
 
 import paramiko
 import pexpect
@@ -16,7 +19,63 @@ servers = dict()
 ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
 
 
+class CommandOutput:
+    """
+    Output of a command running on a server, read as it arrives.
+
+    Iterating yields the stdout lines. stdout and stderr are drained together, so a command with a lot of output on
+    one of them cannot stall on a full SSH window, and only one partial line of each is buffered. stderr lines are
+    passed to stderr_callback, or kept in stderr if there is none. exit_status is set once all of the output was read.
+    """
+    RECV_SIZE = 32768
+
+    def __init__(self, channel, stderr_callback: Callable[[str], None] = None):
+        self.channel = channel
+        self.stderr = []
+        self.stderr_callback = self.stderr.append if stderr_callback is None else stderr_callback
+        self.exit_status = None
+
+    @staticmethod
+    def _decode(line: bytes) -> str:
+        return line.decode("utf-8", "replace").strip()
+
+    def __iter__(self) -> Iterator[str]:
+        channel = self.channel
+        stdout = b""
+        stderr = b""
+        try:
+            while True:
+                if channel.recv_ready():
+                    stdout += channel.recv(self.RECV_SIZE)
+                    *lines, stdout = stdout.split(b"\n")
+                    for line in lines:
+                        yield self._decode(line)
+                elif channel.recv_stderr_ready():
+                    stderr += channel.recv_stderr(self.RECV_SIZE)
+                    *lines, stderr = stderr.split(b"\n")
+                    for line in lines:
+                        self.stderr_callback(self._decode(line))
+                elif channel.eof_received or channel.closed:
+                    # EOF comes after all of stdout and stderr. The exit status can come before the end of the output.
+                    if not channel.recv_ready() and not channel.recv_stderr_ready():
+                        break
+                else:
+                    # Wakes up on stdout. stderr is checked at least every 100ms.
+                    select([channel], [], [], 0.1)
+            if stdout:
+                yield self._decode(stdout)
+            if stderr:
+                self.stderr_callback(self._decode(stderr))
+            self.exit_status = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+
 class Server:
+    # Commands run at once by exec_async(), each on its own channel. OpenSSH allows 10 sessions per connection by
+    # default, see MaxSessions in sshd_config.
+    MAX_CHANNELS = 8
+
     def __init__(self, name, ip, user, password, port=22):
         self.name = name
         self._ip = ip
@@ -27,6 +86,7 @@ class Server:
         self._sftp = None
         self._home_dir = None
         self._expect = None
+        self._executor = None
         self.inventory = create_inventory('linux', server=self)
         self._rpyc_session = RPyCSession(self)
 
@@ -42,21 +102,54 @@ class Server:
         self._conn = s
 
     def exec_return_all(self, command):
-        stdout_lines = []
-        stderr_lines = []
-        log.debug(f"Executing command: {command}")
-        stdin, stdout, stderr = self.conn.exec_command(command)
-        exit_status = stdout.channel.recv_exit_status()
-        for line in stdout.readlines():
-            stdout_lines.append(line.strip())
-        for line in stderr.readlines():
-            stderr_lines.append(line.strip())
+        """Run the command and return its stdout lines, stderr lines and exit status."""
+        output = self.exec_lines(command)
+        stdout_lines = list(output)
+        stderr_lines = output.stderr
         log.debug("STDOUT:\n" + "\n".join(stdout_lines))
         log.debug("STDERR:\n" + "\n".join(stderr_lines))
-        stdout.close()
-        stdin.close()
-        stderr.close()
-        return stdout_lines, stderr_lines, exit_status
+        return stdout_lines, stderr_lines, output.exit_status
+
+    def exec_lines(self, command, stderr_callback: Callable[[str], None] = None) -> CommandOutput:
+        """
+        Start the command and return its output, to be read line by line as it arrives. See CommandOutput.
+
+            output = server.exec_lines("dmesg")
+            for line in output:
+                parse(line)
+            if output.exit_status != 0:
+                ...
+        """
+        log.debug(f"Executing command: {command}")
+        channel = self.conn.get_transport().open_session()
+        channel.exec_command(command)
+        return CommandOutput(channel, stderr_callback)
+
+    def exec_stream(self, command, callback: Callable[[str], None],
+                    stderr_callback: Callable[[str], None] = None) -> int:
+        """Run the command, call callback with each stdout line as it arrives and return the exit status."""
+        output = self.exec_lines(command, stderr_callback)
+        for line in output:
+            callback(line)
+        return output.exit_status
+
+    def exec_async(self, command) -> Future:
+        """
+        Start the command on its own channel of the SSH connection and return a future of exec_return_all(command).
+
+        Up to MAX_CHANNELS commands are in flight at once, so a group of commands costs about one round trip instead of
+        one per command.
+        """
+        # Connect before the command is handed to a worker thread, so the workers share one connection
+        self.conn
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.MAX_CHANNELS, thread_name_prefix=f"exec-{self.name}")
+        return self._executor.submit(self.exec_return_all, command)
+
+    def exec_all(self, commands: List[str]) -> List[Tuple[List[str], List[str], int]]:
+        """Run the commands concurrently, see exec_async(), and return exec_return_all() of each in order."""
+        futures = [self.exec_async(command) for command in commands]
+        return [future.result() for future in futures]
 
     def exec(self, command, exit_on_failure=True, **kwargs):
         stdout, stderr, exit_status = self.exec_return_all(command)
@@ -143,6 +236,17 @@ class Server:
     def import_module(self, module):
         return self._rpyc_session.import_module(module)
 
+    def serve(self, timeout=1):
+        return self._rpyc_session.serve(timeout)
+
+    @property
+    def pci_bdfs(self) -> List[str]:
+        """Return the PCI BDFs of the server's NICs. In config, nic: pci_bdf is a single BDF or a list of them."""
+        pci_bdf = config['servers'][self.name]['nic']['pci_bdf'].get()
+        if isinstance(pci_bdf, list):
+            return [str(x) for x in pci_bdf]
+        return [str(pci_bdf)]
+
     @property
     def rpyc_timeout(self):
         return self._rpyc_session.timeout
@@ -5,7 +5,8 @@ from server_utils.helpers import setup_logging
 from typing import Callable, List, Any
 import threading
 import ctypes
-from time import sleep
+from heapq import heappush, heappop
+from time import sleep, time
 
 
 class KillableThread(threading.Thread):
@@ -53,6 +54,56 @@ class KillableThread(threading.Thread):
         self.raise_exception(SystemExit)
 
 
+class TaggedQueue:
+    """
+    Queue adapter that puts (host time, tag, item) on the target queue, so several readers can share one queue.
+
+    The time is taken on the host the reader runs on. When readers on a remote server put on a client queue through
+    RPyC, their items can be merged in time order with TimeOrderedMerge.
+    """
+
+    def __init__(self, queue, tag):
+        self.queue = queue
+        self.tag = tag
+
+    def put(self, item):
+        self.queue.put((time(), self.tag, item))
+
+
+class TimeOrderedMerge:
+    """
+    Merge the (host time, tag, item) entries of several TaggedQueues into host time order.
+
+    The entries of one reader arrive in order, but entries of different readers may arrive out of order. Each entry is
+    held for delay seconds after it arrives, so entries from the other readers with an earlier time can catch up.
+    """
+
+    def __init__(self, delay: float = 0.5):
+        self.delay = delay
+        # (host time, arrival count, arrival time, entry). The count keeps entries with equal times in arrival order.
+        self._heap = []
+        self._count = 0
+
+    def add(self, entry):
+        heappush(self._heap, (entry[0], self._count, time(), entry))
+        self._count += 1
+
+    def pop_ready(self) -> List:
+        """Return the entries that have been held long enough, in host time order."""
+        ready = []
+        now = time()
+        while self._heap and now - self._heap[0][2] >= self.delay:
+            ready.append(heappop(self._heap)[3])
+        return ready
+
+    def flush(self) -> List:
+        """Return all entries in host time order."""
+        ready = []
+        while self._heap:
+            ready.append(heappop(self._heap)[3])
+        return ready
+
+
 class ServerJob(KillableThread):
     def __init__(self, target, args, server_name):
         # Create the server object